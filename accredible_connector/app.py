@@ -8,9 +8,14 @@ from flask_wtf import FlaskForm
 from flask_wtf.csrf import CSRFProtect
 from redis import StrictRedis
 from requests.auth import HTTPBasicAuth
+from rq import get_current_job
+from rq.decorators import job
+from rq_scheduler import Scheduler
 from werkzeug.contrib.fixers import ProxyFix
 from wtforms import StringField, IntegerField
 
+from caches import TTLCache, TokenCache
+
 
 # app setup
 app = Flask(__name__)
@@ -25,9 +30,14 @@ csrf = CSRFProtect(app)
 
 # some helpers
 redis_store = StrictRedis.from_url(app.config['REDIS_URL'], db=app.config['REDIS_DB'], decode_responses=True)
+rq_store = StrictRedis.from_url(app.config['REDIS_URL'], db=app.config['REDIS_DB'])
+
 
+integration_info_cache = TTLCache(app.config['INTEGRATION_CACHE_SIZE'], app.config['INTEGRATION_CACHE_TTL'],
+                                  name='integration_info')
 
-def get_integration_info(exam_id):
+
+def load_integration_info(exam_id):
     data = redis_store.get(exam_id)
     if data:
         return loads(data)
@@ -40,64 +50,54 @@ def get_integration_info(exam_id):
     return data
 
 
-class ConfigureForm(FlaskForm):
-    api_key = StringField('API Key')
-    group_id = IntegerField('Group ID')
-    name_map = StringField('Name Map')
-    email_map = StringField('Email Map')
+def get_integration_info(exam_id, fresh=False):
+    # fresh=True skips the cached copy, for callers that change and save it
+    if fresh:
+        data = load_integration_info(exam_id)
+        integration_info_cache.set(exam_id, data)
+    else:
+        data = integration_info_cache.get(exam_id, load_integration_info)
+    return dict(data)
 
 
-# views
-@app.route('/')
-def index():
-    return render_template('index.html')
+def save_integration_info(exam_id, data):
+    redis_store.set(exam_id, dumps(data))
+    integration_info_cache.set(exam_id, dict(data))
 
 
-@app.route('/sei_redirect')
-def sei_redirect():
-    confirm_token = request.args.get('confirm_token')
-    if not confirm_token:
-        abort(400)
-    url = app.config['SEI_URL_BASE'] + '/api/integrations/confirm/' + confirm_token
-    resp = requests.get(url, auth=HTTPBasicAuth(username=app.config['SEI_ID'], password=app.config['SEI_SECRET']))
-    if resp.status_code != 200:
-        abort(400)
-    data = resp.json()
-    exam_id = data['exam_id']
-    secret = data['secret']
-    existing_data = redis_store.get(exam_id)
-    if existing_data:
-        existing_data = loads(existing_data)
-        existing_data.update(data)
-        data = existing_data
-    redis_store.set(exam_id, dumps(data))
-    now = datetime.utcnow()
-    exp_seconds = 3600
-    exp_time = (now + timedelta(seconds=exp_seconds))
-    payload = {'iss': 'SEI', 'sub': exam_id, 'iat': now, 'exp': exp_time}
-    token = jwt.encode(payload, secret, algorithm='HS256').decode()
-    return redirect(url_for('configure', jwt=token, exam_id=exam_id))
+token_cache = TokenCache(app.config['JWT_CACHE_SIZE'])
 
 
-@app.route('/delivery_completed', methods=['POST'])
-@csrf.exempt
-def delivery_completed():
-    # authorize the request
-    body = request.get_json()
-    exam_id = body['exam_id']
+def should_retry(error, attempt):
+    """Whether a failed job is worth trying again: only connection problems
+    and 5xx or 429 answers, and only JOB_RETRIES times."""
+    if attempt >= app.config['JOB_RETRIES']:
+        return False
+    if isinstance(error, requests.HTTPError):
+        status_code = error.response.status_code if error.response is not None else 0
+        return status_code >= 500 or status_code == 429
+    return isinstance(error, requests.RequestException)
+
+
+def retry_later(attempt, func, *args, **kwargs):
+    """Schedules the job again on the queue it came from, after
+    JOB_RETRY_BACKOFF seconds and twice as long each attempt after. The
+    scheduler (python scheduler.py) moves it onto the queue when it's due."""
+    current_job = get_current_job()
+    queue_name = current_job.origin if current_job else app.config['QUEUES'][0]
+    scheduler = Scheduler(queue_name=queue_name, connection=rq_store)
+    delay = timedelta(seconds=app.config['JOB_RETRY_BACKOFF'] * 2 ** attempt)
+    scheduler.enqueue_in(delay, func, *args, attempt=attempt + 1, **kwargs)
+
+
+def send_credential(exam_id, delivery_id):
     integration_info = get_integration_info(exam_id)
-    auth_header = request.headers.get('Authorization')
-    token = auth_header.split()[1]
-    try:
-        decoded = jwt.decode(token, integration_info['secret'], algorithms=['HS256'])
-    except jwt.exceptions.InvalidTokenError:
-        return jsonify(), 403
 
     # get full delivery object from SEI
-    delivery_id = body['delivery_id']
     delivery_url = '{0}/api/exams/{1}/deliveries/{2}?include=exam'.format(app.config['SEI_URL_BASE'], exam_id, delivery_id)
     delivery_headers = {'Authorization': 'Bearer {0}'.format(integration_info['token'])}
     delivery_response = requests.get(delivery_url, headers=delivery_headers)
+    delivery_response.raise_for_status()
     delivery_json = delivery_response.json()
     api_key = integration_info.get('api_key')
     group_id = integration_info.get('group_id')
@@ -131,7 +131,9 @@ def delivery_completed():
                     break
 
         if not name or not email:
-            return jsonify(), 400
+            # trying again won't help, the examinee info doesn't have them
+            app.logger.warning('no name or email for delivery %s of exam %s', delivery_id, exam_id)
+            return
 
         payload = {
             'credential': {
@@ -147,6 +149,74 @@ def delivery_completed():
             'Authorization': 'Token token={0}'.format(api_key)
         }
         response = requests.post(url, json=payload, headers=headers)
+        response.raise_for_status()
+
+
+@job('default', connection=rq_store)
+def post_credential(exam_id, delivery_id, attempt=0):
+    try:
+        send_credential(exam_id, delivery_id)
+    except Exception as e:
+        if not should_retry(e, attempt):
+            raise
+        retry_later(attempt, post_credential, exam_id, delivery_id)
+
+
+class ConfigureForm(FlaskForm):
+    api_key = StringField('API Key')
+    group_id = IntegerField('Group ID')
+    name_map = StringField('Name Map')
+    email_map = StringField('Email Map')
+
+
+# views
+@app.route('/')
+def index():
+    return render_template('index.html')
+
+
+@app.route('/sei_redirect')
+def sei_redirect():
+    confirm_token = request.args.get('confirm_token')
+    if not confirm_token:
+        abort(400)
+    url = app.config['SEI_URL_BASE'] + '/api/integrations/confirm/' + confirm_token
+    resp = requests.get(url, auth=HTTPBasicAuth(username=app.config['SEI_ID'], password=app.config['SEI_SECRET']))
+    if resp.status_code != 200:
+        abort(400)
+    data = resp.json()
+    exam_id = data['exam_id']
+    secret = data['secret']
+    existing_data = redis_store.get(exam_id)
+    if existing_data:
+        existing_data = loads(existing_data)
+        existing_data.update(data)
+        data = existing_data
+    save_integration_info(exam_id, data)
+    now = datetime.utcnow()
+    exp_seconds = 3600
+    exp_time = (now + timedelta(seconds=exp_seconds))
+    payload = {'iss': 'SEI', 'sub': exam_id, 'iat': now, 'exp': exp_time}
+    token = jwt.encode(payload, secret, algorithm='HS256').decode()
+    return redirect(url_for('configure', jwt=token, exam_id=exam_id))
+
+
+@app.route('/delivery_completed', methods=['POST'])
+@csrf.exempt
+def delivery_completed():
+    # authorize the request
+    body = request.get_json()
+    exam_id = body['exam_id']
+    integration_info = get_integration_info(exam_id)
+    auth_header = request.headers.get('Authorization')
+    token = auth_header.split()[1]
+    try:
+        decoded = token_cache.decode(token, integration_info['secret'])
+    except jwt.exceptions.InvalidTokenError:
+        return jsonify(), 403
+
+    # the credential is issued by a worker, so SEI isn't kept waiting
+    post_credential.delay(exam_id, body['delivery_id'])
     return jsonify()
 
 
@@ -157,7 +227,7 @@ def delivery_widget():
     token = request.args.get('jwt')
     integration_info = get_integration_info(exam_id)
     try:
-        decoded = jwt.decode(token, integration_info['secret'], algorithms=['HS256'])
+        decoded = token_cache.decode(token, integration_info['secret'])
     except jwt.exceptions.InvalidTokenError:
         abort(403)
     return render_template('delivery_widget.html', exam_id=exam_id, delivery_id=delivery_id, token=token)
@@ -167,9 +237,9 @@ def delivery_widget():
 def configure():
     exam_id = request.args.get('exam_id')
     token = request.args.get('jwt')
-    integration_info = get_integration_info(exam_id)
+    integration_info = get_integration_info(exam_id, fresh=True)
     try:
-        decoded = jwt.decode(token, integration_info['secret'], algorithms=['HS256'])
+        decoded = token_cache.decode(token, integration_info['secret'])
     except jwt.exceptions.InvalidTokenError:
         abort(403)
     form = ConfigureForm(**integration_info)
@@ -178,7 +248,7 @@ def configure():
         integration_info['group_id'] = form.group_id.data
         integration_info['name_map'] = form.name_map.data
         integration_info['email_map'] = form.email_map.data
-        redis_store.set(exam_id, dumps(integration_info))
+        save_integration_info(exam_id, integration_info)
         return redirect(url_for('complete'))
     else:
         url = '{0}/api/exams/{1}?only=examinee_schema'.format(app.config['SEI_URL_BASE'], exam_id)
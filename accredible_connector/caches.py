@@ -0,0 +1,115 @@
+"""In-process caches that expire their values and count their hits.
+
+Each connector is built and deployed from its own directory, with no package
+shared between them, so this module is copied into every one that caches.
+Keep the copies the same; those without tokens to check leave out TokenCache.
+"""
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from threading import Lock
+
+import jwt
+
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """Values kept in process for `ttl` seconds, at most `max_size` of them,
+    least recently used going first.
+
+    get() loads a key that isn't cached with `load`, and when several threads
+    miss on the same key at once only one of them loads it while the rest
+    wait. None is never cached. `hits` and `misses` count lookups, stats()
+    reports them and they are logged every `log_every` lookups.
+    """
+
+    log_every = 1000
+
+    def __init__(self, max_size, ttl, name='cache'):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.loading = {}
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.time():
+                return None
+            self.entries.move_to_end(key)
+        self.count(hit=True)
+        return entry[1]
+
+    def get(self, key, load):
+        value = self.lookup(key)
+        if value is not None:
+            return value
+
+        with self.lock:
+            loading = self.loading.setdefault(key, Lock())
+        try:
+            with loading:
+                value = self.lookup(key)
+                if value is None:
+                    value = self.load(key, load)
+        finally:
+            with self.lock:
+                self.loading.pop(key, None)
+        return value
+
+    def load(self, key, load):
+        self.count(hit=False)
+        value = load(key)
+        if value is not None:
+            self.set(key, value)
+        return value
+
+    def count(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            total = self.hits + self.misses
+        if total % self.log_every == 0:
+            logger.info('%s: %s', self.name, self.stats())
+
+    def expires_at(self, value):
+        return time.time() + self.ttl
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (self.expires_at(value), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries),
+                    'hit_rate': round(self.hits / total, 2) if total else None}
+
+
+class TokenCache(TTLCache):
+    """Widget and webhook tokens that already passed verification, so the same
+    token polled again isn't decoded again. They are keyed by a hash of the
+    secret and the token, and kept until they expire."""
+
+    def __init__(self, max_size):
+        super().__init__(max_size, None, name='tokens')
+
+    def expires_at(self, decoded):
+        return decoded.get('exp') or float('inf')
+
+    def decode(self, token, secret):
+        """jwt.decode() for HS256 tokens, raising InvalidTokenError the same way."""
+        key = hashlib.sha256('{0}\0{1}'.format(secret, token).encode('utf-8')).digest()
+        return dict(self.get(key, lambda key: jwt.decode(token, secret, algorithms=['HS256'])))
@@ -0,0 +1,8 @@
+from rq_scheduler import Scheduler
+
+from app import rq_store
+
+if __name__ == '__main__':
+    # moves jobs scheduled to be retried onto their queue once they're due
+    scheduler = Scheduler(connection=rq_store, interval=1.0)
+    scheduler.run()
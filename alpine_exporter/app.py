@@ -1,17 +1,21 @@
 from datetime import datetime, timedelta
-from json import loads, dumps
+from json import loads
 
 import jwt
 import requests
-from flask import Flask, render_template, request, abort, Response, redirect, url_for
+from flask import Flask, render_template, request, abort, Response, redirect, url_for, jsonify
 from flask_wtf import FlaskForm
 from flask_wtf.csrf import CSRFProtect
 from requests.auth import HTTPBasicAuth
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
 from werkzeug.contrib.fixers import ProxyFix
-from wtforms import StringField, IntegerField
+from wtforms import StringField, IntegerField, SelectField
 from wtforms.validators import Optional, ValidationError
 
-from helpers import redis_store, get_integration_info, Exporter
+from helpers import redis_store, rq_store, export_cache, token_cache, get_integration_info, save_integration_info, \
+    create_exporter, modified_since
+from jobs import run_export
 
 # app setup
 app = Flask(__name__)
@@ -32,6 +36,7 @@ class ConfigureForm(FlaskForm):
     sftp_user = StringField('FTP User')
     sftp_password = StringField('FTP Password')
     sftp_path = StringField('FTP Path')
+    export_format = SelectField('File Format', choices=[('csv', 'CSV'), ('parquet', 'Parquet')], default='csv')
     last_timestamp = StringField('Last Pulled At (Changing this value might cause deliveries to be duplicated or missed)')
 
     def validate_sftp_path(self, field):
@@ -61,7 +66,7 @@ def sei_redirect():
         existing_data = loads(existing_data)
         existing_data.update(data)
         data = existing_data
-    redis_store.set(exam_id, dumps(data))
+    save_integration_info(exam_id, data)
     return render_template('complete.html')
 
 
@@ -71,7 +76,7 @@ def export_widget():
     token = request.args.get('jwt')
     integration_info = get_integration_info(exam_id)
     try:
-        decoded = jwt.decode(token, integration_info['secret'], algorithms=['HS256'])
+        decoded = token_cache.decode(token, integration_info['secret'])
     except jwt.exceptions.InvalidTokenError:
         abort(403)
     return render_template('export_widget.html', exam_id=exam_id, token=token)
@@ -83,7 +88,7 @@ def export():
     token = request.args.get('jwt')
     integration_info = get_integration_info(exam_id)
     try:
-        decoded = jwt.decode(token, integration_info['secret'], algorithms=['HS256'])
+        decoded = token_cache.decode(token, integration_info['secret'])
     except jwt.exceptions.InvalidTokenError:
         abort(403)
 
@@ -96,21 +101,87 @@ def export():
         end_obj += timedelta(hours=24)
         end = end_obj.strftime('%Y-%m-%d')
 
-    exporter = Exporter(exam_id, integration_info, type, start, end)
-
-    filename = exporter.filename
-    response = Response(exporter.generate_csv(bom=True), mimetype='text/csv')
+    output_format = request.args.get('format')
+    if request.args.get('background'):
+        # made by a worker instead, the widget polls /export_status until it can be downloaded
+        job = run_export.delay(exam_id, type, start, end, output_format)
+        return jsonify(job_id=job.id)
+
+    # serve the same export again while no delivery has changed since it was made
+    cache_key = export_cache.key(exam_id, integration_info, type, output_format, start, end)
+    cached = export_cache.get_info(cache_key)
+    if cached and not modified_since(exam_id, integration_info, cached['created_at']):
+        response = Response(export_cache.iter_data(cache_key), mimetype=cached['mimetype'])
+        filename = cached['filename']
+    else:
+        if cached:
+            export_cache.delete(cache_key)
+        exporter = create_exporter(exam_id, integration_info, type, start, end, engine=request.args.get('engine'),
+                                   output_format=output_format)
+        response = Response(export_cache.record(cache_key, exporter, exporter.generate_file(bom=True)),
+                            mimetype=exporter.mimetype)
+        filename = exporter.filename
     response.headers['Content-Disposition'] = 'attachment; filename="{0}"'.format(filename)
     return response
 
 
+def get_export_job(exam_id, job_id):
+    try:
+        job = Job.fetch(job_id, connection=rq_store)
+    except NoSuchJobError:
+        abort(404)
+    if job.func_name != 'jobs.run_export' or job.args[0] != exam_id:
+        abort(404)
+    return job
+
+
+@app.route('/export_status')
+def export_status():
+    exam_id = request.args.get('exam_id')
+    token = request.args.get('jwt')
+    integration_info = get_integration_info(exam_id)
+    try:
+        decoded = token_cache.decode(token, integration_info['secret'])
+    except jwt.exceptions.InvalidTokenError:
+        abort(403)
+
+    job = get_export_job(exam_id, request.args.get('job_id'))
+    status = job.get_status()
+    download_url = None
+    if status == 'finished':
+        download_url = url_for('export_download', exam_id=exam_id, jwt=token, job_id=job.id)
+    return jsonify(status=status, pages=job.meta.get('pages', 0), rows=job.meta.get('rows', 0),
+                   download_url=download_url)
+
+
+@app.route('/export_download')
+def export_download():
+    exam_id = request.args.get('exam_id')
+    token = request.args.get('jwt')
+    integration_info = get_integration_info(exam_id)
+    try:
+        decoded = token_cache.decode(token, integration_info['secret'])
+    except jwt.exceptions.InvalidTokenError:
+        abort(403)
+
+    job = get_export_job(exam_id, request.args.get('job_id'))
+    cache_key = job.result
+    cached = export_cache.get_info(cache_key) if cache_key else None
+    if cached is None:
+        abort(404)
+
+    response = Response(export_cache.iter_data(cache_key), mimetype=cached['mimetype'])
+    response.headers['Content-Disposition'] = 'attachment; filename="{0}"'.format(cached['filename'])
+    return response
+
+
 @app.route('/configure', methods=['GET', 'POST'])
 def configure():
     exam_id = request.args.get('exam_id')
     token = request.args.get('jwt')
-    integration_info = get_integration_info(exam_id)
+    integration_info = get_integration_info(exam_id, fresh=True)
     try:
-        decoded = jwt.decode(token, integration_info['secret'], algorithms=['HS256'])
+        decoded = token_cache.decode(token, integration_info['secret'])
     except jwt.exceptions.InvalidTokenError:
         abort(403)
     form = ConfigureForm(**integration_info)
@@ -122,8 +193,10 @@ def configure():
         integration_info['sftp_user'] = form.sftp_user.data
         integration_info['sftp_password'] = form.sftp_password.data
         integration_info['sftp_path'] = form.sftp_path.data
+        integration_info['export_format'] = form.export_format.data
         integration_info['last_timestamp'] = form.last_timestamp.data
-        redis_store.set(exam_id, dumps(integration_info))
+        save_integration_info(exam_id, integration_info)
+        export_cache.delete_exam(exam_id)
         if integration_info['sftp_host']:
             redis_store.sadd('cron_ids', exam_id)
         else:
@@ -0,0 +1,167 @@
+import asyncio
+import queue
+import threading
+from collections import deque
+
+import aiohttp
+
+from async_request import RETRY_STATUSES
+from config import SEI_URL_BASE, ASYNC_CONCURRENCY, HTTP_RETRIES, HTTP_BACKOFF
+from helpers import Exporter
+
+
+class AsyncExporter(Exporter):
+    """Exporter that fetches pages and item versions and builds rows on one
+    asyncio event loop running in a background thread.
+
+    At most `concurrency` requests to SEI are in flight at once and pages are
+    fetched `prefetch_pages` ahead, each together with the item versions it
+    needs. Rows are built and the item version cache (which talks to redis)
+    is used in the loop's executor, so the loop itself only waits on SEI.
+    Finished pages of rows are handed to iter_page_rows() through a bounded
+    queue, so the caller only has to write them out.
+    """
+
+    done = object()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.concurrency = ASYNC_CONCURRENCY
+        self.version_tasks = {}
+
+    def iter_page_rows(self):
+        if self.backfill_windows > 1 and not self.start:
+            # backfills already fetch their windows side by side
+            yield from super().iter_page_rows()
+            return
+
+        pages = queue.Queue(maxsize=max(self.prefetch_pages, 1))
+        stop = threading.Event()
+        thread = threading.Thread(target=self.run_loop, args=(pages, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                page = pages.get()
+                if page is self.done:
+                    return
+                if isinstance(page, BaseException):
+                    raise page
+                yield page
+        finally:
+            stop.set()
+            thread.join()
+
+    def put_page(self, pages, stop, page):
+        while not stop.is_set():
+            try:
+                pages.put(page, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def run_loop(self, pages, stop):
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self.produce(pages, stop))
+        except BaseException as e:
+            self.put_page(pages, stop, e)
+        else:
+            self.put_page(pages, stop, self.done)
+        finally:
+            loop.run_until_complete(loop.shutdown_asyncgens())
+            loop.close()
+
+    async def produce(self, pages, stop):
+        loop = asyncio.get_event_loop()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        async with aiohttp.ClientSession(headers=self.headers, connector=connector) as session:
+            ready_pages = self.fetch_pages(session, semaphore)
+            try:
+                async for data in ready_pages:
+                    page = await loop.run_in_executor(None, self.page_rows, data['results'], data['has_next'])
+                    await loop.run_in_executor(None, self.put_page, pages, stop, page)
+                    if stop.is_set():
+                        return
+            finally:
+                await ready_pages.aclose()
+
+    async def get_json(self, session, semaphore, url):
+        """Gets url, retrying busy answers and dropped connections the way the
+        requests session in async_request does."""
+        for attempt in range(HTTP_RETRIES + 1):
+            delay = HTTP_BACKOFF * 2 ** attempt
+            try:
+                async with semaphore:
+                    async with session.get(url) as r:
+                        if r.status == 200:
+                            return await r.json(content_type=None)
+                        if r.status not in RETRY_STATUSES or attempt == HTTP_RETRIES:
+                            raise ValueError('{0}: SEI answered {1}'.format(url, r.status))
+                        retry_after = r.headers.get('Retry-After', '')
+                        if retry_after.isdigit():
+                            delay = max(delay, int(retry_after))
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt == HTTP_RETRIES:
+                    raise
+            await asyncio.sleep(delay)
+
+    async def fetch_pages(self, session, semaphore):
+        pending = deque()
+        next_page = 1
+        last_page = None
+        window = self.prefetch_pages
+        try:
+            while True:
+                while len(pending) <= window and (last_page is None or next_page <= last_page):
+                    pending.append(asyncio.ensure_future(self.fetch_ready_page(session, semaphore, next_page)))
+                    next_page += 1
+                if not pending:
+                    return
+
+                data = await pending.popleft()
+                if last_page is None:
+                    last_page = self.page_count(data)
+                    if last_page is not None:
+                        window = max(self.prefetch_pages, self.page_fan_out)
+                yield data
+
+                if not data['has_next']:
+                    return
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def fetch_ready_page(self, session, semaphore, page):
+        """Fetches a page of deliveries along with the item versions it needs."""
+        url = self.deliveries_url() + '&page={0}'.format(str(page))
+        data = await self.get_json(session, semaphore, url)
+        if self.type in {'all', 'item', 'sect'}:
+            await self.populate_item_versions(session, semaphore, data['results'])
+        return data
+
+    async def populate_item_versions(self, session, semaphore, deliveries):
+        item_version_ids = [resp['item_version_id'] for delivery in deliveries for resp in delivery['item_responses']
+                            if resp['type'] == 'main']
+        loop = asyncio.get_event_loop()
+        new_item_version_ids = await loop.run_in_executor(None, self.item_version_cache.missing, item_version_ids)
+        tasks = []
+        for item_version_id in new_item_version_ids:
+            # pages fetched side by side often share item versions, only ask for each once
+            task = self.version_tasks.get(item_version_id)
+            if task is None:
+                url = '{sei_url_base}/api/exams/{exam_id}/item_versions/{item_version_id}?include=item'\
+                    .format(sei_url_base=SEI_URL_BASE, exam_id=self.exam_id, item_version_id=item_version_id)
+                task = asyncio.ensure_future(self.get_json(session, semaphore, url))
+                self.version_tasks[item_version_id] = task
+                self.stats['item_version_requests'] += 1
+                self.stats['item_versions_fetched'] += 1
+            tasks.append(task)
+
+        if tasks:
+            item_versions = await asyncio.gather(*tasks)
+            await loop.run_in_executor(None, self.item_version_cache.update,
+                                       {item_version['id']: item_version for item_version in item_versions})
+            for item_version_id in new_item_version_ids:
+                self.version_tasks.pop(item_version_id, None)
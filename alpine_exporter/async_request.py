@@ -1,14 +1,52 @@
+import os
+from threading import Lock
+
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 from requests_futures.sessions import FuturesSession
 
+from config import HTTP_POOL_SIZE, HTTP_RETRIES, HTTP_BACKOFF
+
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_session = None
+_session_pid = None
+_session_lock = Lock()
+
 
 def json_response_hook(resp, *args, **kwargs):
-    resp.json = resp.json()
+    # None when the response isn't json, e.g. an error page, callers check
+    try:
+        resp.json = resp.json()
+    except ValueError:
+        resp.json = None
+
+def get_session():
+    """Returns the process wide session, so connections to SEI are kept alive
+    and reused by every request instead of opening a new pool each time."""
+    global _session, _session_pid
+    with _session_lock:
+        # a forked worker can't use its parent's executor threads
+        if _session is None or _session_pid != os.getpid():
+            retry = Retry(total=HTTP_RETRIES, backoff_factor=HTTP_BACKOFF, status_forcelist=RETRY_STATUSES,
+                          raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+            session = FuturesSession(max_workers=HTTP_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+            _session_pid = os.getpid()
+        return _session
+
+def get(resource, headers=None):
+    return get_session().get(resource, headers=headers).result()
 
 def map(session_options, resources):
-    with FuturesSession(max_workers=4) as session:
-        session.headers = session_options.get('headers')
+    session = get_session()
+    headers = session_options.get('headers')
 
-        futures = [session.get(resource, hooks={'response': json_response_hook})\
-            for resource in resources]
-        results = [future.result() for future in futures]
-        return results
+    futures = [session.get(resource, headers=headers, hooks={'response': json_response_hook})\
+        for resource in resources]
+    results = [future.result() for future in futures]
+    return results
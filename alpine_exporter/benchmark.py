@@ -0,0 +1,159 @@
+"""Benchmarks for the exporter's row building, run against a synthetic exam.
+
+    python benchmark.py --deliveries 10000
+
+Nothing here talks to SEI or redis: every item version is put in the
+exporter's local cache up front. Each line times the current code against
+what it replaced as kept in this file, not against the baseline Exporter:
+item and sect rows built in two passes (item_values() then sect_values())
+against one, and the original letter encoding against the lookup tables.
+"""
+import argparse
+import random
+import time
+
+from helpers import Exporter, compile_item_version, response_to_alpha
+from item_cache import ItemVersionCache, LRUCache
+
+
+EXAM_ID = 'benchmark'
+
+
+def make_item_versions(count, rng):
+    item_versions = {}
+    for index in range(count):
+        option_count = rng.randint(2, 8)
+        key = [0] * option_count
+        for option in rng.sample(range(option_count), rng.randint(1, 2)):
+            key[option] = 1
+        item_versions['iv{0}'.format(index)] = {
+            'id': 'iv{0}'.format(index),
+            'settings': {
+                'type': 'multiple_choice' if index % 10 else 'short_answer',
+                'points': sum(key),
+                'scoring': rng.choice(['partial', 'all']),
+                'key': key
+            },
+            'content': {'options': ['option'] * option_count},
+            'item': {'content_area': 'Section {0}|Objective {1}'.format(index % 8, index % 3)}
+        }
+    return item_versions
+
+
+def make_deliveries(count, responses, item_versions, rng):
+    item_version_ids = sorted(item_versions)
+    deliveries = []
+    for index in range(count):
+        item_responses = []
+        for item_version_id in rng.sample(item_version_ids, responses):
+            option_count = len(item_versions[item_version_id]['content']['options'])
+            final = rng.choice([None, [], [rng.randrange(option_count)], rng.sample(range(option_count), 2)])
+            item_responses.append({
+                'item_version_id': item_version_id,
+                'item_version_name': 'Item {0}'.format(item_version_id),
+                'type': 'main' if rng.random() < 0.9 else 'pilot',
+                'score': rng.choice([0, 1, 0.5]) if final else 0,
+                'seconds': rng.random() * 120,
+                'final': final
+            })
+        deliveries.append({
+            'id': 'delivery{0}'.format(index),
+            'examinee_id': 'examinee{0}'.format(index),
+            'examinee': {'info': {'id': 'client{0}'.format(index)}},
+            'item_responses': item_responses,
+            'breakdown_objects': [{'area': 'Section {0}|'.format(section), 'earned': 3, 'possible': 5}
+                                  for section in range(8)]
+        })
+    return deliveries
+
+
+def make_exporter(item_versions):
+    exporter = Exporter(EXAM_ID, {'token': 'benchmark'}, 'all', None, None, exam_title='Benchmark Exam')
+    exporter.item_version_cache = ItemVersionCache(None, EXAM_ID, local=LRUCache(len(item_versions)))
+    for item_version_id, item_version in item_versions.items():
+        exporter.item_version_cache.local.set((EXAM_ID, item_version_id), compile_item_version(item_version))
+    return exporter
+
+
+def best_of(repeat, func, *args):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def separate_passes(exporter, deliveries):
+    for delivery in deliveries:
+        exporter.item_values(delivery)
+        exporter.sect_values(delivery)
+
+
+def single_pass(exporter, deliveries):
+    for delivery in deliveries:
+        exporter.response_values(delivery)
+
+
+def reference_list_to_alpha(l, offset=65):
+    # list_to_alpha as it was before the letter table, to check against
+    alpha = []
+    for index, value in enumerate(l):
+        if value:
+            letters = []
+            while index >= 0:
+                letters.append(chr(index % 25 + offset))
+                index -= 25
+            alpha.append(''.join(letters))
+    return ''.join(alpha)
+
+
+def reference_response_to_alpha(final, option_count):
+    if final is None:
+        return ''
+
+    response = []
+    for index in range(option_count):
+        if index in final:
+            response.append(1)
+        else:
+            response.append(0)
+    return reference_list_to_alpha(response)
+
+
+def encode_answers(encode, answers):
+    for final, option_count in answers:
+        encode(final, option_count)
+
+
+def report(name, replaced, current):
+    print('{0:<30} {1:8.3f}s {2:8.3f}s {3:6.2f}x'.format(name, replaced, current, replaced / current))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--deliveries', type=int, default=10000)
+    parser.add_argument('--responses', type=int, default=40, help='item responses per delivery')
+    parser.add_argument('--item-versions', type=int, default=300)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    item_versions = make_item_versions(args.item_versions, rng)
+    deliveries = make_deliveries(args.deliveries, args.responses, item_versions, rng)
+    exporter = make_exporter(item_versions)
+
+    print('{0} deliveries, {1} item responses each'.format(args.deliveries, args.responses))
+    print('{0:<30} {1:>9} {2:>9} {3:>7}'.format('', 'replaced', 'current', ''))
+    report('item and sect rows, 2 passes', best_of(args.repeat, separate_passes, exporter, deliveries),
+           best_of(args.repeat, single_pass, exporter, deliveries))
+
+    answers = [(item_response.get('final'), len(item_versions[item_response['item_version_id']]['content']['options']))
+               for delivery in deliveries for item_response in delivery['item_responses']]
+    report('letters, original encoding', best_of(args.repeat, encode_answers, reference_response_to_alpha, answers),
+           best_of(args.repeat, encode_answers, response_to_alpha, answers))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from config import PARQUET_ROW_GROUP_SIZE
+
+
+class ChunkSink:
+    """A write-only file that keeps what is written until it is drained.
+
+    The parquet writer needs tell() to keep counting from the start of the
+    file, even though the bytes have already been handed on.
+    """
+
+    closed = False
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        chunk = b''.join(self.parts)
+        self.parts = []
+        return chunk
+
+
+class ParquetWriter:
+    """Writes export rows as a parquet file, the same way CSVWriter writes csv.
+
+    The first row is the header and names the (string) columns. Rows are
+    written out a row group of row_group_size at a time, and each finished
+    row group is handed back as bytes, so an export never holds more than
+    one row group in memory.
+    """
+
+    def __init__(self, row_group_size=PARQUET_ROW_GROUP_SIZE):
+        self.row_group_size = row_group_size
+        self.rows = []
+        self.sink = ChunkSink()
+        self.schema = None
+        self.writer = None
+
+    def writerow(self, row):
+        if self.writer is None:
+            self.schema = pa.schema([(column, pa.string()) for column in row])
+            self.writer = pq.ParquetWriter(self.sink, self.schema)
+            return None
+
+        self.rows.append(row)
+        if len(self.rows) >= self.row_group_size:
+            return self.flush()
+
+    def flush(self):
+        """Ends the current row group and returns the bytes written so far."""
+        if self.rows:
+            columns = zip(*self.rows)
+            arrays = [pa.array([None if value is None else str(value) for value in column], type=pa.string())
+                      for column in columns]
+            self.writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+            self.rows = []
+        return self.sink.drain()
+
+    def end_page(self):
+        """Returns the row groups finished so far. The page's rows stay
+        buffered until there are row_group_size of them, so pages don't end
+        row groups."""
+        return self.sink.drain()
+
+    def close(self):
+        chunk = self.flush()
+        self.writer.close()
+        return chunk + self.sink.drain()
@@ -1,5 +1,6 @@
 import os
 from json import loads
+from tempfile import gettempdir
 
 
 SECRET_KEY = os.environ.get('SECRET_KEY', 'devkey')
@@ -15,3 +16,84 @@ REDIS_DB = int(os.environ.get('REDIS_DB', '1'))
 QUEUES = loads(os.environ.get('QUEUES', '["default", "low"]'))
 
 CHECK_SECRET = loads(os.environ.get('CHECK_SECRET', 'false'))
+
+# pages of deliveries fetched ahead of the one being exported, and how many
+# pages to fetch at once when SEI reports the total up front (0 to disable)
+PREFETCH_PAGES = int(os.environ.get('PREFETCH_PAGES', '2'))
+PAGE_FAN_OUT = int(os.environ.get('PAGE_FAN_OUT', '0'))
+
+# item versions are cached per process (count) and in redis (count per exam, seconds)
+ITEM_CACHE_LOCAL_SIZE = int(os.environ.get('ITEM_CACHE_LOCAL_SIZE', '5000'))
+ITEM_CACHE_MAX_SIZE = int(os.environ.get('ITEM_CACHE_MAX_SIZE', '20000'))
+ITEM_CACHE_TTL = int(os.environ.get('ITEM_CACHE_TTL', str(60 * 60 * 24 * 30)))
+
+# fetch item versions in batches from the item_versions list endpoint where
+# SEI supports it, otherwise in chunks of parallel single requests
+BULK_ITEM_VERSIONS = loads(os.environ.get('BULK_ITEM_VERSIONS', 'false'))
+ITEM_VERSION_BATCH_SIZE = int(os.environ.get('ITEM_VERSION_BATCH_SIZE', '50'))
+ITEM_VERSION_CHUNK_SIZE = int(os.environ.get('ITEM_VERSION_CHUNK_SIZE', '100'))
+
+# shared connection pool to SEI; failed GETs (429/5xx) are retried with backoff
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '8'))
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', '3'))
+HTTP_BACKOFF = float(os.environ.get('HTTP_BACKOFF', '0.5'))
+
+# 'threaded' or 'asyncio', and how many requests the asyncio engine keeps in flight
+EXPORT_ENGINE = os.environ.get('EXPORT_ENGINE', 'threaded')
+ASYNC_CONCURRENCY = int(os.environ.get('ASYNC_CONCURRENCY', '8'))
+
+# worker processes used to build rows, for very large 'all' exports (0 to disable)
+EXPORT_PROCESSES = int(os.environ.get('EXPORT_PROCESSES', '0'))
+
+# characters of CSV built up before a chunk is written out
+CSV_CHUNK_SIZE = int(os.environ.get('CSV_CHUNK_SIZE', str(64 * 1024)))
+
+# rows per row group in parquet exports
+PARQUET_ROW_GROUP_SIZE = int(os.environ.get('PARQUET_ROW_GROUP_SIZE', '50000'))
+
+# bytes of each compressed zip entry kept in memory before spilling to disk,
+# and bytes sent per block when uploading the zip
+ZIP_SPOOL_SIZE = int(os.environ.get('ZIP_SPOOL_SIZE', str(8 * 1024 * 1024)))
+TRANSFER_BLOCK_SIZE = int(os.environ.get('TRANSFER_BLOCK_SIZE', str(256 * 1024)))
+
+# nightly exports: at most MAX_CONCURRENT_EXPORTS run against SEI at once
+# (a slot is given up after EXPORT_SLOT_TIMEOUT seconds), start times are
+# spread over EXPORT_WINDOW seconds, and exams whose last export had more
+# than LARGE_EXPORT_DELIVERIES deliveries run on the last queue in QUEUES
+MAX_CONCURRENT_EXPORTS = int(os.environ.get('MAX_CONCURRENT_EXPORTS', '4'))
+EXPORT_SLOT_TIMEOUT = int(os.environ.get('EXPORT_SLOT_TIMEOUT', str(60 * 60 * 4)))
+EXPORT_RETRY_DELAY = int(os.environ.get('EXPORT_RETRY_DELAY', '300'))
+EXPORT_WINDOW = int(os.environ.get('EXPORT_WINDOW', str(60 * 60 * 2)))
+LARGE_EXPORT_DELIVERIES = int(os.environ.get('LARGE_EXPORT_DELIVERIES', '10000'))
+
+# csv exports from jobs are checkpointed to EXPORT_WORK_DIR every
+# EXPORT_CHECKPOINT_PAGES pages so they can be resumed for EXPORT_CHECKPOINT_TTL
+# seconds, and split into jobs of EXPORT_CHUNK_PAGES pages (0 for no limit)
+EXPORT_WORK_DIR = os.environ.get('EXPORT_WORK_DIR', os.path.join(gettempdir(), 'alpine_exports'))
+EXPORT_CHECKPOINT_PAGES = int(os.environ.get('EXPORT_CHECKPOINT_PAGES', '10'))
+EXPORT_CHECKPOINT_TTL = int(os.environ.get('EXPORT_CHECKPOINT_TTL', str(60 * 60 * 24 * 2)))
+EXPORT_CHUNK_PAGES = int(os.environ.get('EXPORT_CHUNK_PAGES', '0'))
+
+# exports of an exam's whole history are split into this many time windows
+# fetched at once (0 to disable), overlapping by BACKFILL_OVERLAP seconds
+BACKFILL_WINDOWS = int(os.environ.get('BACKFILL_WINDOWS', '0'))
+BACKFILL_OVERLAP = int(os.environ.get('BACKFILL_OVERLAP', '1'))
+
+# finished /export downloads are cached compressed in redis for
+# EXPORT_CACHE_TTL seconds, up to EXPORT_CACHE_MAX_SIZE bytes in all and
+# EXPORT_CACHE_MAX_ENTRY_SIZE bytes for a single export
+EXPORT_CACHE_TTL = int(os.environ.get('EXPORT_CACHE_TTL', str(60 * 60)))
+EXPORT_CACHE_MAX_SIZE = int(os.environ.get('EXPORT_CACHE_MAX_SIZE', str(256 * 1024 * 1024)))
+EXPORT_CACHE_MAX_ENTRY_SIZE = int(os.environ.get('EXPORT_CACHE_MAX_ENTRY_SIZE', str(32 * 1024 * 1024)))
+
+# exports run in the background for the export widget time out after
+# EXPORT_JOB_TIMEOUT seconds and can be up to EXPORT_JOB_MAX_SIZE bytes compressed
+EXPORT_JOB_TIMEOUT = int(os.environ.get('EXPORT_JOB_TIMEOUT', str(60 * 60 * 2)))
+EXPORT_JOB_MAX_SIZE = int(os.environ.get('EXPORT_JOB_MAX_SIZE', str(128 * 1024 * 1024)))
+
+# integration info is cached in each process (exams, seconds) in front of redis
+INTEGRATION_CACHE_SIZE = int(os.environ.get('INTEGRATION_CACHE_SIZE', '1000'))
+INTEGRATION_CACHE_TTL = int(os.environ.get('INTEGRATION_CACHE_TTL', '30'))
+
+# tokens that passed verification are remembered until they expire (count)
+JWT_CACHE_SIZE = int(os.environ.get('JWT_CACHE_SIZE', '10000'))
@@ -0,0 +1,141 @@
+import hashlib
+import time
+import zlib
+from json import loads, dumps
+
+from config import EXPORT_CACHE_TTL, EXPORT_CACHE_MAX_SIZE, EXPORT_CACHE_MAX_ENTRY_SIZE
+
+
+class ExportCache:
+    """Finished exports kept in redis so the same download doesn't crawl SEI
+    again.
+
+    Each export is stored zlib compressed under its exam, the exam's export
+    settings (exam code and secret), type, format and date range for `ttl`
+    seconds, along with the time it was started. Once
+    the cached exports add up to more than `max_size` bytes the least
+    recently used ones are evicted, and exports that compress to more than
+    `max_entry_size` bytes (or the limit given to record()) aren't cached at
+    all. Whether SEI has changed
+    since an export was made is left to the caller.
+    """
+
+    key_format = 'export_cache:{exam_id}:{settings}:{type}:{output_format}:{start}:{end}'
+    exam_prefix = 'export_cache:{exam_id}:'
+    index_key = 'export_cache_index'
+    sizes_key = 'export_cache_sizes'
+    block_size = 64 * 1024
+
+    def __init__(self, redis, ttl=EXPORT_CACHE_TTL, max_size=EXPORT_CACHE_MAX_SIZE,
+                 max_entry_size=EXPORT_CACHE_MAX_ENTRY_SIZE):
+        self.redis = redis
+        self.ttl = ttl
+        self.max_size = max_size
+        self.max_entry_size = max_entry_size
+
+    def key(self, exam_id, integration_info, type, output_format, start, end):
+        # the settings that end up in the rows, hashed so the secret isn't in the key
+        settings = dumps([integration_info.get('exam_code'), integration_info.get('jwt_secret')])
+        return self.key_format.format(exam_id=exam_id, settings=hashlib.sha1(settings.encode('utf-8')).hexdigest(),
+                                      type=type, output_format=output_format or 'csv', start=start or '',
+                                      end=end or '')
+
+    def get_info(self, key):
+        """Returns the filename, mimetype and created_at of a cached export, or None."""
+        info = self.redis.hget(key, 'info')
+        if info is None:
+            return None
+        self.redis.zadd(self.index_key, {key: time.time()})
+        return loads(info)
+
+    def iter_data(self, key):
+        """Yields the cached export, decompressed a block at a time."""
+        data = self.redis.hget(key, 'data')
+        if data is None:
+            return
+        decompressor = zlib.decompressobj()
+        for i in range(0, len(data), self.block_size):
+            chunk = decompressor.decompress(data[i:i + self.block_size])
+            if chunk:
+                yield chunk
+        yield decompressor.flush()
+
+    def record(self, key, exporter, chunks, max_entry_size=None):
+        """Passes the chunks of an export through, and caches the export once
+        all of it has been produced."""
+        max_entry_size = max_entry_size or self.max_entry_size
+        compressor = zlib.compressobj()
+        parts = []
+        size = 0
+        for chunk in chunks:
+            yield chunk
+            if parts is None:
+                continue
+            data = compressor.compress(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+            if data:
+                parts.append(data)
+                size += len(data)
+            if size > max_entry_size:
+                parts = None
+
+        if parts is not None:
+            parts.append(compressor.flush())
+            info = {'filename': exporter.filename, 'mimetype': exporter.mimetype, 'created_at': exporter.created_at}
+            self.set(key, b''.join(parts), info)
+
+    def set(self, key, data, info):
+        pipe = self.redis.pipeline()
+        pipe.hset(key, 'data', data)
+        pipe.hset(key, 'info', dumps(info))
+        pipe.expire(key, self.ttl)
+        pipe.zadd(self.index_key, {key: time.time()})
+        pipe.hset(self.sizes_key, key, len(data))
+        pipe.execute()
+        self.prune()
+        total = sum(int(size) for size in self.redis.hvals(self.sizes_key))
+        if total > self.max_size:
+            self.evict(total - self.max_size)
+
+    def prune(self):
+        """Drops exports that have expired from the index and sizes, so they
+        don't count towards max_size."""
+        keys = self.redis.hkeys(self.sizes_key)
+        if not keys:
+            return
+        pipe = self.redis.pipeline()
+        for key in keys:
+            pipe.exists(key)
+        expired = [key for key, exists in zip(keys, pipe.execute()) if not exists]
+        if expired:
+            pipe = self.redis.pipeline()
+            pipe.zrem(self.index_key, *expired)
+            pipe.hdel(self.sizes_key, *expired)
+            pipe.execute()
+
+    def evict(self, excess):
+        """Drops least recently used exports until `excess` bytes are freed."""
+        while excess > 0:
+            oldest = self.redis.zrange(self.index_key, 0, 0)
+            if not oldest:
+                return
+            key = oldest[0]
+            size = self.redis.hget(self.sizes_key, key)
+            pipe = self.redis.pipeline()
+            pipe.delete(key)
+            pipe.zrem(self.index_key, key)
+            pipe.hdel(self.sizes_key, key)
+            pipe.execute()
+            excess -= int(size or 0)
+
+    def delete(self, key):
+        pipe = self.redis.pipeline()
+        pipe.delete(key)
+        pipe.zrem(self.index_key, key)
+        pipe.hdel(self.sizes_key, key)
+        pipe.execute()
+
+    def delete_exam(self, exam_id):
+        """Drops every cached export of the exam, e.g. once its settings change."""
+        prefix = self.exam_prefix.format(exam_id=exam_id)
+        for key, _ in self.redis.zscan_iter(self.index_key, match=prefix + '*'):
+            self.delete(key)
@@ -1,6 +1,11 @@
 import codecs
+import csv
 import ftplib
-from datetime import datetime
+import io
+import logging
+import multiprocessing
+import ssl
+from datetime import datetime, timedelta
 from json import loads, dumps
 from urllib.parse import quote_plus
 import collections
@@ -10,21 +15,40 @@ import requests
 from redis import StrictRedis
 from requests.auth import HTTPBasicAuth
 import async_request
+from caches import TTLCache, TokenCache
+from export_cache import ExportCache
+from item_cache import ItemVersionCache
+from prefetch import PagePrefetcher, WindowedPages, parse_timestamp, split_windows
 
-from config import REDIS_URL, REDIS_DB, CHECK_SECRET, SEI_URL_BASE, SEI_ID, SEI_SECRET
+from config import REDIS_URL, REDIS_DB, CHECK_SECRET, SEI_URL_BASE, SEI_ID, SEI_SECRET, PREFETCH_PAGES, PAGE_FAN_OUT, \
+    BULK_ITEM_VERSIONS, ITEM_VERSION_BATCH_SIZE, ITEM_VERSION_CHUNK_SIZE, EXPORT_ENGINE, \
+    EXPORT_PROCESSES, CSV_CHUNK_SIZE, BACKFILL_WINDOWS, BACKFILL_OVERLAP, INTEGRATION_CACHE_SIZE, \
+    INTEGRATION_CACHE_TTL, JWT_CACHE_SIZE
 
 
 redis_store = StrictRedis.from_url(REDIS_URL, db=REDIS_DB, decode_responses=True)
 rq_store = StrictRedis.from_url(REDIS_URL, db=REDIS_DB)
+# finished exports are compressed, so they live on the connection that doesn't decode
+export_cache = ExportCache(rq_store)
+
+logger = logging.getLogger(__name__)
 
 SCORPION_SECTION = 0
 SCORPION_OBJECTIVE = 1
 SCORPION_SPLIT_CHAR = '|'
 
+def chunks(l, size):
+    for index in range(0, len(l), size):
+        yield l[index:index + size]
+
 def extract_section(content_area):
     return content_area.split(SCORPION_SPLIT_CHAR)[SCORPION_SECTION] or ''
 
-def get_integration_info(exam_id):
+
+integration_info_cache = TTLCache(INTEGRATION_CACHE_SIZE, INTEGRATION_CACHE_TTL, name='integration_info')
+
+
+def load_integration_info(exam_id):
     data = redis_store.get(exam_id)
     if data:
         return loads(data)
@@ -37,6 +61,24 @@ def get_integration_info(exam_id):
     return data
 
 
+def get_integration_info(exam_id, fresh=False):
+    # fresh=True skips the cached copy, for callers that change and save it
+    if fresh:
+        data = load_integration_info(exam_id)
+        integration_info_cache.set(exam_id, data)
+    else:
+        data = integration_info_cache.get(exam_id, load_integration_info)
+    return dict(data)
+
+
+def save_integration_info(exam_id, data):
+    redis_store.set(exam_id, dumps(data))
+    integration_info_cache.set(exam_id, dict(data))
+
+
+token_cache = TokenCache(JWT_CACHE_SIZE)
+
+
 class InvalidSecretError(Exception):
     pass
 
@@ -51,31 +93,93 @@ def get_item_type(item_version):
             return 'm'
         return 's'
 
+def option_letters(index, offset=65):
+    letters = []
+    while index >= 0:
+        letters.append(chr(index % 25 + offset))
+        index -= 25
+    return ''.join(letters)
+
+# letters for the first options, looked up instead of built for every answer
+OPTION_LETTERS = [option_letters(index) for index in range(256)]
+
+# response letters by bitmask of the options chosen, filled in as they're seen
+mask_letters = {}
+MASK_LETTERS_MAX = 65536
+
 def list_to_alpha(l, offset=65):
-    alpha = []
-    for index, value in enumerate(l):
-        if value:
-            letters = []
-            while index >= 0:
-                letters.append(chr(index % 25 + offset))
-                index -= 25
-            alpha.append(''.join(letters))
-    return ''.join(alpha)
+    if offset != 65 or len(l) > len(OPTION_LETTERS):
+        return ''.join([option_letters(index, offset) for index, value in enumerate(l) if value])
+    return ''.join([OPTION_LETTERS[index] for index, value in enumerate(l) if value])
+
+def mask_to_alpha(mask):
+    alpha = mask_letters.get(mask)
+    if alpha is None:
+        letters = []
+        index = 0
+        while mask >> index:
+            if mask >> index & 1:
+                letters.append(OPTION_LETTERS[index] if index < len(OPTION_LETTERS) else option_letters(index))
+            index += 1
+        alpha = ''.join(letters)
+        if len(mask_letters) < MASK_LETTERS_MAX:
+            mask_letters[mask] = alpha
+    return alpha
 
 def item_response_to_alpha(item_response, item_version):
-    final = item_response.get('final')
-    content = item_version['content']
+    return response_to_alpha(item_response.get('final'), len(item_version['content']['options']))
 
+def response_to_alpha(final, option_count):
     if final is None:
         return ''
 
-    response = []
-    for index in range(len(content['options'])):
-        if index in final:
-            response.append(1)
-        else:
-            response.append(0)
-    return list_to_alpha(response)
+    if option_count > len(OPTION_LETTERS):
+        return list_to_alpha([index in final for index in range(option_count)])
+
+    mask = 0
+    try:
+        for index in final:
+            # indexes past the options are left out before shifting, so a
+            # malformed answer can't build a huge mask
+            if 0 <= index < option_count:
+                mask |= 1 << index
+    except TypeError:
+        # not a list of option indexes, compare each option the slow way
+        return list_to_alpha([index in final for index in range(option_count)])
+    return mask_to_alpha(mask)
+
+# everything about an item version the export needs, worked out once when
+# the version is cached instead of for every response to it
+CompiledItemVersion = collections.namedtuple('CompiledItemVersion', [
+    'id',
+    'multiple_choice',
+    'item_type',
+    'correct_answer',
+    'section',
+    'section_label',
+    'option_count'
+])
+
+def compile_item_version(item_version):
+    item = item_version['item']
+    if item_version['settings']['type'] != 'multiple_choice':
+        return CompiledItemVersion(item_version['id'], False, None, None, None, None, 0)
+
+    section = extract_section(item['content_area'])
+    return CompiledItemVersion(
+        id=item_version['id'],
+        multiple_choice=True,
+        item_type=get_item_type(item_version),
+        correct_answer=list_to_alpha(item_version['settings']['key']),
+        section=section,
+        section_label='{0}...'.format(section[:47]) if len(section) > 50 else section,
+        option_count=len(item_version['content']['options'])
+    )
+
+# the rows built for a page of deliveries, the modified_at of the last delivery
+# that exported cleanly and of the last one on the page, how many there were
+# and whether more pages follow
+PageRows = collections.namedtuple('PageRows', ['rows', 'last_timestamp', 'modified_at', 'deliveries', 'has_next'])
 
 def get_item_status(item_response):
     score = item_response['score']
@@ -87,15 +191,34 @@ def get_item_status(item_response):
 
     return 'i'
 
-def as_safe_string(value):
-    if value is None:
-        return ''
+class CSVWriter:
+    """Formats rows as CSV (quoting commas, quotes and newlines properly) and
+    hands them back joined into chunks of about chunk_size characters, so
+    output is written a chunk at a time instead of a row at a time."""
 
-    str_value = str(value)
-    if ',' in str_value:
-        return '"{str_value}"'.format(str_value=str_value)
+    def __init__(self, chunk_size=CSV_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer, lineterminator='\r\n')
 
-    return str_value
+    def writerow(self, row):
+        """Returns a chunk once enough rows have built up, otherwise None."""
+        self.writer.writerow(row)
+        if self.buffer.tell() >= self.chunk_size:
+            return self.flush()
+
+    def flush(self):
+        chunk = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return chunk
+
+    def end_page(self):
+        """Returns everything written so far, so a page never straddles chunks."""
+        return self.flush()
+
+    def close(self):
+        return self.flush()
 
 class Exporter:
     all_columns = [
@@ -180,12 +303,21 @@ class Exporter:
     split_idx = 25
     empty_cand_values = ['' for x in range(20)]
 
-    def __init__(self, exam_id, integration_info, type, start, end):
+    output_formats = {
+        'csv': ('.csv', 'text/csv'),
+        'parquet': ('.parquet', 'application/octet-stream')
+    }
+
+    def __init__(self, exam_id, integration_info, type, start, end, exam_title=None, output_format='csv'):
         self.exam_id = exam_id
         self.integration_info = integration_info
         self.type = type
         if self.type not in {'exam', 'cand', 'all', 'item', 'sect'}:
             raise ValueError('type must be exam, cand, item, or all')
+        self.output_format = output_format or 'csv'
+        if self.output_format not in self.output_formats:
+            raise ValueError('output_format must be csv or parquet')
+        self.extension, self.mimetype = self.output_formats[self.output_format]
         self.start = start
         self.end = end
 
@@ -195,7 +327,8 @@ class Exporter:
 
         # set filename
         now = datetime.utcnow()
-        self.filename = now.strftime('%Y%m%d-%H%M%S.csv')
+        self.created_at = now.isoformat()
+        self.filename = now.strftime('%Y%m%d-%H%M%S') + self.extension
         if type == 'cand':
             self.filename = 'cand-' + self.filename
         elif type == 'exam':
@@ -205,16 +338,28 @@ class Exporter:
         elif type == 'sect':
             self.filename = 'sect-' + self.filename
 
-        # fetch exam
-        exam_url = '{0}/api/exams/{1}?only=name'.format(SEI_URL_BASE, self.exam_id)
-        exam_resp = requests.get(exam_url, headers=self.headers)
+        # fetch exam, unless the caller already knows its title
+        if exam_title is None:
+            exam_url = '{0}/api/exams/{1}?only=name'.format(SEI_URL_BASE, self.exam_id)
+            exam_resp = async_request.get(exam_url, headers=self.headers)
+            exam_title = exam_resp.json()['name']
 
-        self.exam_title = exam_resp.json()['name']
-        self.exam_title = self.exam_title.replace('"', '')
-        self.exam_title_escaped = '"{}"'.format(self.exam_title)
+        self.exam_title = exam_title.replace('"', '')
         self.exam_code = integration_info.get('exam_code') or ''.join([x[0].upper() for x in self.exam_title.split(' ')])
         self.last_timestamp = None
-        self.item_version_cache = {}
+        # modified_at of the last delivery written out, exported cleanly or not
+        self.modified_at = None
+        self.item_version_cache = ItemVersionCache(redis_store, exam_id, compiler=compile_item_version)
+
+        # how many pages of deliveries to fetch ahead of the one being written
+        self.prefetch_pages = PREFETCH_PAGES
+        self.page_fan_out = PAGE_FAN_OUT
+        # time windows a full history export is split into and fetched side by side
+        self.backfill_windows = BACKFILL_WINDOWS
+
+        self.bulk_item_versions = BULK_ITEM_VERSIONS
+        self.processes = EXPORT_PROCESSES
+        self.stats = collections.Counter()
 
     def get_client_id(self, examinee_info):
         client_id = examinee_info.get('id')
@@ -288,7 +433,7 @@ class Exporter:
             score,
             str(int(bool(delivery['rescored_at']))),
             cutscore,
-            self.exam_title_escaped,
+            self.exam_title,
             '',
             '',
             str(delivery['form_id']),
@@ -304,70 +449,35 @@ class Exporter:
         return values
 
     def item_values(self, delivery):
-        # check secret here to keep them in line
-        self.get_client_id(delivery['examinee']['info'])
-
-        item_responses = delivery['item_responses']
-        main_item_responses = [resp for resp in item_responses if resp['type'] == 'main']
-        self.populate_item_version_cache(main_item_responses)
-        values = []
-
-        for item_response in main_item_responses:
-            item_version = self.item_version_cache[item_response['item_version_id']]
-            item = item_version['item']
-
-            if item_version['settings']['type'] != 'multiple_choice':
-                continue
-
-            item_response['delivery_id'] = delivery['id']
-            values.append(self.item_response_values(item, item_version, item_response))
-        return values
-
-    def item_response_values(self, item, item_version, item_response):
-        item_exam_id = item_response['delivery_id']
-        item_name = item_response['item_version_name']
-        item_type = get_item_type(item_version)
-        item_status = get_item_status(item_response)
-        item_score = item_response['score']
-        item_time_spent = int(round(item_response['seconds']))
-        item_response_ = item_response_to_alpha(item_response, item_version)
-        item_correct_answer = list_to_alpha(item_version['settings']['key'])
-        item_section = extract_section(item['content_area'])
-
-        item_values = [
-            item_exam_id,
-            item_name,
-            item_type,
-            item_status,
-            item_score,
-            item_time_spent,
-            item_response_,
-            item_correct_answer,
-            '{0}...'.format(item_section[:47]) if len(item_section) > 50 else item_section
-        ]
-
-        return map(as_safe_string, item_values)
+        return self.response_values(delivery, sects=False)[0]
 
-    def sect_values(self, delivery):
+    def response_values(self, delivery, items=True, sects=True):
+        """Returns the item rows and the sect rows for a delivery, built in one
+        pass over its item responses."""
         # check secret here to keep them in line
         self.get_client_id(delivery['examinee']['info'])
 
         item_responses = delivery['item_responses']
         main_item_responses = [resp for resp in item_responses if resp['type'] == 'main']
         self.populate_item_version_cache(main_item_responses)
-        
+        item_rows = []
+
         content_area_correct = collections.Counter()
         content_area_incorrect = collections.Counter()
         content_area_skipped = collections.Counter()
 
         for item_response in main_item_responses:
             item_version = self.item_version_cache[item_response['item_version_id']]
-            item = item_version['item']
+            if not item_version.multiple_choice:
+                continue
 
-            if item_version['settings']['type'] != 'multiple_choice':
+            if items:
+                item_rows.append(self.item_response_values(delivery['id'], item_version, item_response))
+
+            if not sects:
                 continue
 
-            content_area = extract_section(item['content_area'])
+            content_area = item_version.section
             if item_response.get('final', None) is None or len(item_response.get('final')) == 0:
                 content_area_skipped[content_area] += 1
                 continue
@@ -377,6 +487,30 @@ class Exporter:
             else:
                 content_area_incorrect[content_area] += 1
 
+        sect_rows = []
+        if sects:
+            sect_rows = self.breakdown_values(delivery, content_area_correct, content_area_incorrect, content_area_skipped)
+        return item_rows, sect_rows
+
+    def item_response_values(self, delivery_id, item_version, item_response):
+        item_values = [
+            delivery_id,
+            item_response['item_version_name'],
+            item_version.item_type,
+            get_item_status(item_response),
+            item_response['score'],
+            int(round(item_response['seconds'])),
+            response_to_alpha(item_response.get('final'), item_version.option_count),
+            item_version.correct_answer,
+            item_version.section_label
+        ]
+
+        return item_values
+
+    def sect_values(self, delivery):
+        return self.response_values(delivery, items=False)[1]
+
+    def breakdown_values(self, delivery, content_area_correct, content_area_incorrect, content_area_skipped):
         response_content_areas = set(list(content_area_correct) + list(content_area_incorrect) + list(content_area_skipped))
         breakdown_objects = [ breakdown_object for breakdown_object in delivery['breakdown_objects'] if extract_section(breakdown_object['area']) in response_content_areas ]
 
@@ -414,85 +548,282 @@ class Exporter:
                 sect_std_error
             ]
 
-            values.append(map(as_safe_string, breakdown_values))
+            values.append(breakdown_values)
 
         return values
 
     def populate_item_version_cache(self, item_responses):
         all_item_version_ids = [resp['item_version_id'] for resp in item_responses]
-        new_item_version_ids = [version_id for version_id in all_item_version_ids if version_id not in self.item_version_cache]
-        ready_requests = []
+        new_item_version_ids = self.item_version_cache.missing(all_item_version_ids)
+        if not new_item_version_ids:
+            return
 
-        for item_version_id in new_item_version_ids:
-            url = '{sei_url_base}/api/exams/{exam_id}/item_versions/{item_version_id}?include=item'\
-                .format(sei_url_base=SEI_URL_BASE, exam_id=self.exam_id, item_version_id=item_version_id)
-            ready_requests.append(url)
+        if self.bulk_item_versions:
+            new_item_version_ids = self.fetch_item_versions_bulk(new_item_version_ids)
+
+        for chunk in chunks(new_item_version_ids, ITEM_VERSION_CHUNK_SIZE):
+            ready_requests = []
+            for item_version_id in chunk:
+                url = '{sei_url_base}/api/exams/{exam_id}/item_versions/{item_version_id}?include=item'\
+                    .format(sei_url_base=SEI_URL_BASE, exam_id=self.exam_id, item_version_id=item_version_id)
+                ready_requests.append(url)
 
-        if len(ready_requests) > 0:
             responses = async_request.map({ 'headers': self.headers }, ready_requests)
+            for response in responses:
+                if response.status_code != 200 or response.json is None:
+                    raise ValueError('could not fetch item version {0}: SEI answered {1}'
+                                     .format(response.url, response.status_code))
             responses_json = [item_version.json for item_version in responses]
             self.item_version_cache.update({ item_version['id']: item_version for item_version in responses_json })
+            self.stats['item_version_requests'] += len(ready_requests)
+            self.stats['item_versions_fetched'] += len(responses_json)
+
+    def fetch_item_versions_bulk(self, item_version_ids):
+        """Fetches item versions a batch at a time from the item_versions list
+        endpoint and returns the ids it couldn't get that way."""
+        remaining = []
+        batches = list(chunks(item_version_ids, ITEM_VERSION_BATCH_SIZE))
+        ready_requests = []
+        for batch in batches:
+            url = '{sei_url_base}/api/exams/{exam_id}/item_versions?include=item&ids={ids}'\
+                .format(sei_url_base=SEI_URL_BASE, exam_id=self.exam_id, ids=quote_plus(','.join(batch)))
+            ready_requests.append(url)
+
+        responses = async_request.map({ 'headers': self.headers }, ready_requests)
+        self.stats['item_version_requests'] += len(ready_requests)
+        for batch, response in zip(batches, responses):
+            if response.status_code != 200 or response.json is None:
+                # this SEI doesn't support batches, stop trying for the rest of the export
+                self.bulk_item_versions = False
+                remaining.extend(batch)
+                continue
+
+            item_versions = {item_version['id']: item_version for item_version in response.json['results']}
+            self.item_version_cache.update(item_versions)
+            self.stats['item_versions_fetched'] += len(item_versions)
+            remaining.extend(item_version_id for item_version_id in batch if item_version_id not in item_versions)
+        return remaining
+
+    def populate_page(self, deliveries):
+        """Fetches the item versions for a whole page of deliveries at once."""
+        if self.type in {'all', 'item', 'sect'}:
+            self.populate_item_version_cache([resp for delivery in deliveries for resp in delivery['item_responses']
+                                              if resp['type'] == 'main'])
+
+    def log_stats(self):
+        fetched = self.stats['item_versions_fetched']
+        requests_made = self.stats['item_version_requests']
+        logger.info('exam %s: fetched %s item versions in %s requests', self.exam_id, fetched, requests_made)
 
     def all_values(self, delivery):
         return self.cand_values(delivery) + self.exam_values(delivery) + self.item_values(delivery) + self.sect_values(delivery)
 
-    def make_row(self, l):
-        return ','.join(l) + '\r\n'
-
-    def generate(self, get_buffer=None):
-        page = 0
-        has_next = True
-
-        base_url = '{0}/api/exams/{1}/deliveries?status=complete&sort=modified_at&include=item_responses,breakdown_objects'.format(SEI_URL_BASE, self.exam_id)
-        if self.start:
-            base_url += '&modified_after={0}'.format(quote_plus(self.start))
-
-        if self.end:
-            base_url += '&modified_before={0}'.format(quote_plus(self.end))
-
-        if self.type == 'all' or self.type == 'cand':
-            cand_buffer = get_buffer('cand')
-            yield cand_buffer.write(self.make_row(self.cand_columns()))
-        
-        if self.type == 'all' or self.type == 'exam':
-            exam_buffer = get_buffer('exam')
-            yield exam_buffer.write(self.make_row(self.exam_columns()))
-        
-        if self.type == 'all' or self.type == 'item':
-            item_buffer = get_buffer('item')
-            yield item_buffer.write(self.make_row(self.item_columns()))
-
-        if self.type == 'all' or self.type == 'sect':
-            sect_buffer = get_buffer('sect')
-            yield sect_buffer.write(self.make_row(self.sect_columns()))
-
-        while has_next:
-            page += 1
-            url = base_url + '&page={0}'.format(str(page))
-            r = requests.get(url, headers=self.headers)
-            data = r.json()
-            has_next = data['has_next']
-            for delivery in data['results']:
-                try:
-                    if self.type == 'all' or self.type == 'cand':
-                        yield cand_buffer.write(self.make_row(self.cand_values(delivery)))
-                    
-                    if self.type == 'all' or self.type == 'exam':
-                        yield exam_buffer.write(self.make_row(self.exam_values(delivery)))
-                    
-                    if self.type == 'all' or self.type == 'item':
-                        for response_row in self.item_values(delivery):
-                            yield item_buffer.write(self.make_row(response_row))
-                    
-                    if self.type == 'all' or self.type == 'sect':
-                        for sect_row in self.sect_values(delivery):
-                            yield sect_buffer.write(self.make_row(sect_row))
-                except (InvalidSecretError, InvalidDeliveryError):
-                    continue
-                self.last_timestamp = delivery['modified_at']
-
-    def generate_csv(self, bom=False):
-        if bom:
+    def deliveries_url(self, window=None):
+        start, end = self.start, self.end
+        if window is not None:
+            # the (after, before) datetimes of a backfill window, open ends are the export's own
+            after, before = window
+            start = after.isoformat() if after else self.start
+            end = before.isoformat() if before else self.end
+
+        url = '{0}/api/exams/{1}/deliveries?status=complete&sort=modified_at&include=item_responses,breakdown_objects'.format(SEI_URL_BASE, self.exam_id)
+        if start:
+            url += '&modified_after={0}'.format(quote_plus(start))
+
+        if end:
+            url += '&modified_before={0}'.format(quote_plus(end))
+        return url
+
+    def fetch_page(self, page, window=None):
+        url = self.deliveries_url(window) + '&page={0}'.format(str(page))
+        r = async_request.get(url, headers=self.headers)
+        return r.json()
+
+    def page_count(self, data):
+        # only known when SEI reports a total alongside a full first page
+        total = data.get('total')
+        per_page = len(data['results'])
+        if total is None or not per_page or not data['has_next']:
+            return None
+        return -(-total // per_page)
+
+    def iter_pages(self):
+        if self.backfill_windows > 1 and not self.start:
+            return self.iter_backfill_pages()
+        return PagePrefetcher(self.fetch_page, lookahead=self.prefetch_pages, fan_out=self.page_fan_out,
+                              page_count=self.page_count)
+
+    def iter_backfill_pages(self):
+        """Pages of an export of the whole delivery history, split into
+        backfill_windows time windows between the first delivery and the end
+        of the export that are all fetched at once."""
+        first = self.fetch_page(1)
+        if not first['has_next']:
+            yield first
+            return
+
+        start = parse_timestamp(first['results'][0]['modified_at'])
+        end = parse_timestamp(self.end) if self.end else datetime.utcnow()
+        count = self.backfill_windows if end > start else 1
+        windows = split_windows(start, end, count, timedelta(seconds=BACKFILL_OVERLAP))
+        yield from WindowedPages(self.fetch_page, windows)
+
+    def exports(self, row_type):
+        return self.type == 'all' or self.type == row_type
+
+    def header_rows(self):
+        if self.exports('cand'):
+            yield 'cand', self.cand_columns()
+
+        if self.exports('exam'):
+            yield 'exam', self.exam_columns()
+
+        if self.exports('item'):
+            yield 'item', self.item_columns()
+
+        if self.exports('sect'):
+            yield 'sect', self.sect_columns()
+
+    def delivery_rows(self, delivery):
+        """Yields (row_type, row) for each row a delivery adds to the export."""
+        if self.exports('cand'):
+            yield 'cand', self.cand_values(delivery)
+
+        if self.exports('exam'):
+            yield 'exam', self.exam_values(delivery)
+
+        if self.exports('item') or self.exports('sect'):
+            item_rows, sect_rows = self.response_values(delivery, items=self.exports('item'), sects=self.exports('sect'))
+            for response_row in item_rows:
+                yield 'item', response_row
+
+            for sect_row in sect_rows:
+                yield 'sect', sect_row
+
+    def page_rows(self, deliveries, has_next):
+        """Returns the (row_type, row) pairs for a page of deliveries, along
+        with the modified_at of the last delivery that exported cleanly and of
+        the last delivery on the page."""
+        rows = []
+        last_timestamp = None
+        for delivery in deliveries:
+            try:
+                for row in self.delivery_rows(delivery):
+                    rows.append(row)
+            except (InvalidSecretError, InvalidDeliveryError):
+                continue
+            last_timestamp = delivery['modified_at']
+        return PageRows(rows, last_timestamp, deliveries[-1]['modified_at'] if deliveries else None, len(deliveries),
+                        has_next)
+
+    def iter_page_rows(self):
+        """Yields the PageRows for each page of the export, in order."""
+        if self.processes > 1:
+            yield from self.iter_page_rows_parallel()
+            return
+
+        for data in self.iter_pages():
+            self.populate_page(data['results'])
+            yield self.page_rows(data['results'], data['has_next'])
+
+    def iter_page_rows_parallel(self):
+        """Builds the rows for each page in a pool of worker processes.
+
+        Workers are spawned rather than forked, since this process may be
+        monkey patched and has connections and prefetch threads open. Each
+        one builds its own exporter from the same settings and is sent the
+        item versions cached here once, when the pool starts after the first
+        page. Item versions are fetched in this process before a page is
+        handed out, so workers find the rest in redis instead of going to
+        SEI. At most a couple of pages per worker are outstanding at once.
+        """
+        pending = collections.deque()
+        pool = None
+        try:
+            for data in self.iter_pages():
+                self.populate_page(data['results'])
+                if pool is None:
+                    pool = multiprocessing.get_context('spawn').Pool(
+                        self.processes, initializer=init_pool_worker,
+                        initargs=(self.pool_settings(), self.item_version_cache.local_item_versions()))
+                pending.append(pool.apply_async(pool_page_rows, (data['results'], data['has_next'])))
+                if len(pending) >= self.processes * 2:
+                    yield pending.popleft().get()
+
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    def pool_settings(self):
+        # what a pool worker needs to build the same rows, all of it picklable
+        return {
+            'exam_id': self.exam_id,
+            'integration_info': self.integration_info,
+            'type': self.type,
+            'start': self.start,
+            'end': self.end,
+            'exam_title': self.exam_title,
+            'output_format': self.output_format
+        }
+
+    def make_writer(self):
+        if self.output_format == 'parquet':
+            # imported here so pyarrow is only loaded for parquet exports
+            from columnar import ParquetWriter
+            return ParquetWriter()
+        return CSVWriter()
+
+    def generate(self, get_buffer=None, headers=True, on_page=None):
+        """Writes the export to the buffers get_buffer() returns for each row type.
+
+        headers=False carries on a csv export that already has its header
+        rows. When on_page is given, each writer's end_page() is written out
+        before it's called with whether more pages follow (for csv that is
+        every row of the page), and the export stops there, without closing
+        the writers, as soon as it returns True.
+        """
+        buffers = {}
+        writers = {}
+        for row_type, row in self.header_rows():
+            buffers[row_type] = get_buffer(row_type)
+            writers[row_type] = self.make_writer()
+            if not headers:
+                continue
+            chunk = writers[row_type].writerow(row)
+            if chunk:
+                yield buffers[row_type].write(chunk)
+
+        for page in self.iter_page_rows():
+            for row_type, row in page.rows:
+                chunk = writers[row_type].writerow(row)
+                if chunk:
+                    yield buffers[row_type].write(chunk)
+            if page.last_timestamp:
+                self.last_timestamp = page.last_timestamp
+            if page.modified_at:
+                self.modified_at = page.modified_at
+            self.stats['deliveries'] += page.deliveries
+            self.stats['pages'] += 1
+            self.stats['rows'] += len(page.rows)
+
+            if on_page is not None:
+                for row_type, writer in writers.items():
+                    chunk = writer.end_page()
+                    if chunk:
+                        yield buffers[row_type].write(chunk)
+                if on_page(page.has_next):
+                    self.log_stats()
+                    return
+
+        for row_type, writer in writers.items():
+            yield buffers[row_type].write(writer.close())
+
+        self.log_stats()
+
+    def generate_file(self, bom=False, on_page=None):
+        if bom and self.output_format == 'csv':
             yield codecs.BOM_UTF8
 
         def get_buffer(row_type):
@@ -501,10 +832,41 @@ class Exporter:
                     return row
             return ResponseBuffer()
 
-        for row in self.generate(get_buffer=get_buffer):
+        for row in self.generate(get_buffer=get_buffer, on_page=on_page):
             yield row
 
 
+# the exporter each pool worker builds rows with, set once when the worker starts
+pool_exporter = None
+
+def init_pool_worker(settings, item_versions):
+    global pool_exporter
+    pool_exporter = Exporter(**settings)
+    pool_exporter.item_version_cache.preload(item_versions)
+
+def pool_page_rows(deliveries, has_next):
+    return pool_exporter.page_rows(deliveries, has_next)
+
+
+def modified_since(exam_id, integration_info, timestamp):
+    """Whether any complete delivery of the exam has changed after timestamp."""
+    url = '{0}/api/exams/{1}/deliveries?status=complete&per_page=1&modified_after={2}'.format(
+        SEI_URL_BASE, exam_id, quote_plus(timestamp))
+    r = async_request.get(url, headers={'Authorization': 'Bearer {0}'.format(integration_info['token'])})
+    return bool(r.json()['results'])
+
+
+def create_exporter(exam_id, integration_info, type, start, end, engine=None, output_format=None):
+    engine = engine or EXPORT_ENGINE
+    if engine == 'asyncio':
+        # imported here so aiohttp is only loaded when the asyncio engine is used
+        from async_export import AsyncExporter
+        return AsyncExporter(exam_id, integration_info, type, start, end, output_format=output_format)
+    if engine == 'threaded':
+        return Exporter(exam_id, integration_info, type, start, end, output_format=output_format)
+    raise ValueError('engine must be threaded or asyncio')
+
+
 # copied from https://stackoverflow.com/questions/14659154/ftpes-session-reuse-required
 # fixes some bug I'm not old enough to understand
 class MyFTP_TLS(ftplib.FTP_TLS):
@@ -516,3 +878,22 @@ class MyFTP_TLS(ftplib.FTP_TLS):
                                             server_hostname=self.host,
                                             session=self.sock.session)  # this is the fix
         return conn, size
+
+    def storbinary(self, cmd, fp, blocksize=8192, callback=None, rest=None):
+        # ftplib's, except that a server closing the data connection without
+        # ending TLS first doesn't fail the upload, the reply below still does
+        self.voidcmd('TYPE I')
+        with self.transfercmd(cmd, rest) as conn:
+            while True:
+                buf = fp.read(blocksize)
+                if not buf:
+                    break
+                conn.sendall(buf)
+                if callback:
+                    callback(buf)
+            if isinstance(conn, ssl.SSLSocket):
+                try:
+                    conn.unwrap()
+                except OSError:
+                    pass
+        return self.voidresp()
@@ -0,0 +1,147 @@
+import time
+from collections import OrderedDict
+from json import loads, dumps
+from threading import Lock
+
+from config import ITEM_CACHE_LOCAL_SIZE, ITEM_CACHE_MAX_SIZE, ITEM_CACHE_TTL
+
+
+class LRUCache:
+    """A small thread safe least-recently-used mapping."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.data = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                self.data.move_to_end(key)
+            except KeyError:
+                return default
+            return self.data[key]
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.data
+
+    def items(self):
+        with self.lock:
+            return list(self.data.items())
+
+    def __len__(self):
+        return len(self.data)
+
+
+def unchanged(item_version):
+    return item_version
+
+
+# shared by every exporter in the process, in front of redis
+local_item_versions = LRUCache(ITEM_CACHE_LOCAL_SIZE)
+
+
+class ItemVersionCache:
+    """Item versions for one exam, kept across exports.
+
+    Item versions never change once published, so they are cached in an
+    in-process LRU backed by redis. Redis holds the versions as SEI sent
+    them; the local cache holds whatever `compiler` turns them into. Each
+    exam keeps at most `max_size` versions in redis, the least recently used
+    ones are evicted past that, and an exam that isn't exported for `ttl`
+    seconds drops out entirely.
+    """
+
+    key_format = 'item_version:{exam_id}:{item_version_id}'
+    index_format = 'item_versions:{exam_id}'
+
+    def __init__(self, redis, exam_id, local=local_item_versions, max_size=ITEM_CACHE_MAX_SIZE, ttl=ITEM_CACHE_TTL,
+                 compiler=unchanged):
+        self.redis = redis
+        self.compiler = compiler
+        self.exam_id = exam_id
+        self.local = local
+        self.max_size = max_size
+        self.ttl = ttl
+        self.index_key = self.index_format.format(exam_id=exam_id)
+
+    def redis_key(self, item_version_id):
+        return self.key_format.format(exam_id=self.exam_id, item_version_id=item_version_id)
+
+    def __contains__(self, item_version_id):
+        return (self.exam_id, item_version_id) in self.local
+
+    def local_item_versions(self):
+        """The exam's item versions in the local cache, by id, as compiled."""
+        return {key[1]: item_version for key, item_version in self.local.items() if key[0] == self.exam_id}
+
+    def preload(self, item_versions):
+        """Puts item versions compiled elsewhere in the local cache."""
+        for item_version_id, item_version in item_versions.items():
+            self.local.set((self.exam_id, item_version_id), item_version)
+
+    def __getitem__(self, item_version_id):
+        item_version = self.local.get((self.exam_id, item_version_id))
+        if item_version is None:
+            self.load([item_version_id])
+            item_version = self.local.get((self.exam_id, item_version_id))
+            if item_version is None:
+                raise KeyError(item_version_id)
+        return item_version
+
+    def load(self, item_version_ids):
+        """Pulls whatever redis has for item_version_ids into the local cache and
+        returns the ids that were found."""
+        if not item_version_ids:
+            return set()
+        values = self.redis.mget([self.redis_key(item_version_id) for item_version_id in item_version_ids])
+        now = time.time()
+        found = {}
+        for item_version_id, value in zip(item_version_ids, values):
+            if value is not None:
+                self.local.set((self.exam_id, item_version_id), self.compiler(loads(value)))
+                found[item_version_id] = now
+        if found:
+            pipe = self.redis.pipeline()
+            pipe.zadd(self.index_key, found)
+            pipe.expire(self.index_key, self.ttl)
+            pipe.execute()
+        return set(found)
+
+    def missing(self, item_version_ids):
+        """Returns the ids in item_version_ids that have never been fetched for this exam."""
+        unique_ids = list(OrderedDict.fromkeys(item_version_ids))
+        not_local = [item_version_id for item_version_id in unique_ids if item_version_id not in self]
+        found = self.load(not_local)
+        return [item_version_id for item_version_id in not_local if item_version_id not in found]
+
+    def update(self, item_versions):
+        if not item_versions:
+            return
+        now = time.time()
+        pipe = self.redis.pipeline()
+        for item_version_id, item_version in item_versions.items():
+            self.local.set((self.exam_id, item_version_id), self.compiler(item_version))
+            pipe.set(self.redis_key(item_version_id), dumps(item_version), ex=self.ttl)
+        pipe.zadd(self.index_key, {item_version_id: now for item_version_id in item_versions})
+        pipe.expire(self.index_key, self.ttl)
+        pipe.zcard(self.index_key)
+        size = pipe.execute()[-1]
+        if size > self.max_size:
+            self.evict(size - self.max_size)
+
+    def evict(self, count):
+        oldest = self.redis.zrange(self.index_key, 0, count - 1)
+        if oldest:
+            pipe = self.redis.pipeline()
+            pipe.delete(*[self.redis_key(item_version_id) for item_version_id in oldest])
+            pipe.zrem(self.index_key, *oldest)
+            pipe.execute()
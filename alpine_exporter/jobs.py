@@ -1,13 +1,22 @@
-import codecs
-from datetime import datetime
-from json import dumps
-from tempfile import TemporaryDirectory
-from zipfile import ZipFile
+import os
+import shutil
+import time
+from datetime import datetime, timedelta
+from json import loads, dumps
+from urllib.parse import urlparse
+from uuid import uuid4
 
 import paramiko
+from rq import get_current_job
 from rq.decorators import job
+from rq_scheduler import Scheduler
 
-from helpers import redis_store, rq_store, get_integration_info, Exporter, MyFTP_TLS
+from config import SEI_URL_BASE, QUEUES, TRANSFER_BLOCK_SIZE, MAX_CONCURRENT_EXPORTS, EXPORT_WINDOW, \
+    EXPORT_SLOT_TIMEOUT, EXPORT_RETRY_DELAY, LARGE_EXPORT_DELIVERIES, EXPORT_WORK_DIR, EXPORT_CHECKPOINT_PAGES, \
+    EXPORT_CHECKPOINT_TTL, EXPORT_CHUNK_PAGES, EXPORT_CACHE_TTL, EXPORT_JOB_TIMEOUT, EXPORT_JOB_MAX_SIZE
+from helpers import redis_store, rq_store, export_cache, get_integration_info, save_integration_info, create_exporter, \
+    modified_since, MyFTP_TLS
+from streaming_zip import StreamingZip, IterStream
 
 
 def create_sftp_client(host, port, user, password):
@@ -28,67 +37,296 @@ def create_sftp_client(host, port, user, password):
         raise e
 
 
+def upload_file(integration_info, filename, file):
+    with MyFTP_TLS() as ftp:
+        ftp.connect(integration_info['sftp_host'], integration_info.get('sftp_port') or 21)
+        ftp.login(integration_info['sftp_user'], integration_info['sftp_password'])
+        ftp.prot_p()
+        # a failed transfer fails the job, which picks the export up from its checkpoint when run again
+        ftp.storbinary('STOR ' + integration_info['sftp_path'] + filename, file, TRANSFER_BLOCK_SIZE)
+
+
+def schedule_upload(exam_id, delay, queue_name):
+    scheduler = Scheduler(queue_name=queue_name, connection=rq_store)
+    scheduler.enqueue_in(timedelta(seconds=delay), upload_fresh_data, exam_id)
+
+
+def export_slots_key():
+    return 'export_slots:' + urlparse(SEI_URL_BASE).netloc
+
+
+def acquire_export_slot(exam_id):
+    """Takes one of the MAX_CONCURRENT_EXPORTS export slots for the SEI host.
+
+    Slots are a sorted set of tokens, one per job, scored by when they were
+    taken, so a slot held by a worker that died is given back after
+    EXPORT_SLOT_TIMEOUT. Returns the token to release the slot with, or
+    None when every slot is taken.
+    """
+    key = export_slots_key()
+    token = '{0}:{1}'.format(exam_id, uuid4().hex)
+    now = time.time()
+    pipe = redis_store.pipeline()
+    pipe.zremrangebyscore(key, 0, now - EXPORT_SLOT_TIMEOUT)
+    pipe.zadd(key, {token: now})
+    pipe.zrank(key, token)
+    rank = pipe.execute()[-1]
+    if rank is not None and rank < MAX_CONCURRENT_EXPORTS:
+        return token
+    redis_store.zrem(key, token)
+    return None
+
+
+def release_export_slot(token):
+    redis_store.zrem(export_slots_key(), token)
+
+
+@job('default', connection=rq_store, timeout=EXPORT_JOB_TIMEOUT, result_ttl=EXPORT_CACHE_TTL)
+def run_export(exam_id, type, start, end, output_format=None):
+    """Makes an export in the background for /export_download.
+
+    Progress (pages and rows written so far) is kept in the job's meta for
+    /export_status, and the finished export goes into the export cache,
+    under the key the job returns.
+    """
+    current_job = get_current_job()
+    integration_info = get_integration_info(exam_id)
+    cache_key = export_cache.key(exam_id, integration_info, type, output_format, start, end)
+    cached = export_cache.get_info(cache_key)
+    if cached and not modified_since(exam_id, integration_info, cached['created_at']):
+        return cache_key
+
+    exporter = create_exporter(exam_id, integration_info, type, start, end, output_format=output_format)
+
+    def on_page(has_next):
+        if current_job is not None:
+            current_job.meta['pages'] = exporter.stats['pages']
+            current_job.meta['rows'] = exporter.stats['rows']
+            current_job.save_meta()
+
+    chunks = exporter.generate_file(bom=True, on_page=on_page)
+    for _ in export_cache.record(cache_key, exporter, chunks, max_entry_size=EXPORT_JOB_MAX_SIZE):
+        continue
+    if export_cache.get_info(cache_key) is None:
+        raise ValueError('export is too large to download')
+    return cache_key
+
+
 @job('default', connection=rq_store)
 def upload_all():
+    """Schedules the upload for each exam with a nightly export.
+
+    Exams are ordered by how many deliveries their last export had, biggest
+    first, and their start times spread evenly over EXPORT_WINDOW seconds.
+    Exports expected to be large run on the last (lowest priority) queue.
+    """
     cron_ids = redis_store.smembers('cron_ids')
+    exams = []
     for exam_id in cron_ids:
-        upload_fresh_data.delay(exam_id)
+        integration_info = get_integration_info(exam_id)
+        exams.append((integration_info.get('last_delivery_count') or 0, exam_id))
+    exams.sort(reverse=True)
+    remove_abandoned_work_dirs()
+
+    spacing = EXPORT_WINDOW // len(exams) if exams else 0
+    for i, (delivery_count, exam_id) in enumerate(exams):
+        queue_name = QUEUES[-1] if delivery_count > LARGE_EXPORT_DELIVERIES else QUEUES[0]
+        schedule_upload(exam_id, i * spacing, queue_name)
 
 
 @job('default', connection=rq_store)
 def upload_fresh_data(exam_id):
-    integration_info = get_integration_info(exam_id)
+    slot = acquire_export_slot(exam_id)
+    if slot is None:
+        # too many exports running against SEI already, try again later
+        current_job = get_current_job()
+        schedule_upload(exam_id, EXPORT_RETRY_DELAY, current_job.origin if current_job else QUEUES[0])
+        return
+
+    try:
+        finished = export_fresh_data(exam_id)
+    finally:
+        release_export_slot(slot)
+
+    if not finished:
+        # carry on with the rest of a large export in a new job
+        current_job = get_current_job()
+        schedule_upload(exam_id, 0, current_job.origin if current_job else QUEUES[0])
+
+
+def checkpoint_key(exam_id):
+    return 'export_checkpoint:' + exam_id
+
+
+def export_lock(exam_id):
+    # held while an exam exports, given back after EXPORT_SLOT_TIMEOUT if the worker dies
+    return redis_store.lock('export_lock:' + exam_id, timeout=EXPORT_SLOT_TIMEOUT)
+
+
+def exam_work_dir(exam_id):
+    return os.path.join(EXPORT_WORK_DIR, exam_id)
+
+
+def load_checkpoint(exam_id):
+    data = redis_store.get(checkpoint_key(exam_id))
+    if data:
+        checkpoint = loads(data)
+        if os.path.isdir(checkpoint['work_dir']):
+            return checkpoint
+        redis_store.delete(checkpoint_key(exam_id))
+    return None
+
+
+def clear_checkpoint(checkpoint):
+    redis_store.delete(checkpoint_key(checkpoint['exam_id']))
+    shutil.rmtree(checkpoint['work_dir'], ignore_errors=True)
+
+
+def remove_stale_work_dirs(exam_id, checkpoint):
+    """Removes the exam's work directories other than the checkpoint's, left
+    by exports that failed before checkpointing or whose checkpoint expired."""
+    work_dir = exam_work_dir(exam_id)
+    if not os.path.isdir(work_dir):
+        return
+    for name in os.listdir(work_dir):
+        path = os.path.join(work_dir, name)
+        if checkpoint is None or path != checkpoint['work_dir']:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def remove_abandoned_work_dirs():
+    """Removes the work directories of exams that have no checkpoint left and
+    aren't exporting, e.g. exams no longer exported every night."""
+    if not os.path.isdir(EXPORT_WORK_DIR):
+        return
+    for exam_id in os.listdir(EXPORT_WORK_DIR):
+        lock = export_lock(exam_id)
+        if not lock.acquire(blocking=False):
+            continue
+        try:
+            if not redis_store.exists(checkpoint_key(exam_id)):
+                shutil.rmtree(exam_work_dir(exam_id), ignore_errors=True)
+        finally:
+            lock.release()
+
+
+def export_fresh_data(exam_id):
+    """Exports the deliveries modified since the last upload and uploads them.
+
+    Only one job exports an exam at a time; True is returned straight away
+    when another one already is. CSV exports are checkpointed every
+    EXPORT_CHECKPOINT_PAGES pages: the zip entries written so far stay in a
+    work directory and redis keeps where they end and the modified_at of the
+    last delivery in them. A later run for the exam picks the export up from
+    there instead of starting over. After EXPORT_CHUNK_PAGES pages the
+    export checkpoints and stops, and False is returned so the rest can run
+    as a new job.
+    """
+    lock = export_lock(exam_id)
+    if not lock.acquire(blocking=False):
+        return True
+    try:
+        return write_fresh_data(exam_id)
+    finally:
+        lock.release()
+
+
+def write_fresh_data(exam_id):
+    integration_info = get_integration_info(exam_id, fresh=True)
+    output_format = integration_info.get('export_format') or 'csv'
+
+    checkpoint = load_checkpoint(exam_id) if output_format == 'csv' else None
+    if checkpoint is None:
+        start = integration_info.get('last_timestamp')
+        end = datetime.utcnow().isoformat()
+    else:
+        start = checkpoint['modified_at'] or checkpoint['start']
+        end = checkpoint['end']
+    remove_stale_work_dirs(exam_id, checkpoint)
+    exporter = create_exporter(exam_id, integration_info, 'all', start, end, output_format=output_format)
+
+    # rows are compressed into the zip entries as they are written and the
+    # archive is streamed to the server, nothing is written out uncompressed
+    archive = StreamingZip()
+    buffers = {}
+    if checkpoint is not None:
+        exporter.last_timestamp = checkpoint['last_timestamp']
+        exporter.modified_at = checkpoint['modified_at']
+        for row_type, entry in checkpoint['entries'].items():
+            path = os.path.join(checkpoint['work_dir'], entry['name'])
+            buffers[row_type] = archive.open(entry['name'], path=path, state=entry['state'])
+    elif output_format == 'csv':
+        work_dir = os.path.join(exam_work_dir(exam_id), exporter.filename.split('.')[0])
+        os.makedirs(work_dir, exist_ok=True)
+        checkpoint = {
+            'exam_id': exam_id,
+            'start': start,
+            'end': end,
+            'last_timestamp': None,
+            'modified_at': None,
+            'delivery_count': 0,
+            'zip_filename': exam_id + '-' + exporter.filename.split('.')[0] + '.zip',
+            'work_dir': work_dir,
+            'entries': {},
+        }
+        for row_type in ['cand', 'exam', 'item', 'sect']:
+            name = row_type + '-' + exporter.filename
+            buffers[row_type] = archive.open(name, bom=True, path=os.path.join(work_dir, name))
+            checkpoint['entries'][row_type] = {'name': name}
+    else:
+        for row_type in ['cand', 'exam', 'item', 'sect']:
+            buffers[row_type] = archive.open(row_type + '-' + exporter.filename)
+
+    pages = 0
+    paused = False
+
+    def save_checkpoint():
+        for row_type, entry in checkpoint['entries'].items():
+            entry['state'] = buffers[row_type].checkpoint()
+        checkpoint['last_timestamp'] = exporter.last_timestamp
+        checkpoint['modified_at'] = exporter.modified_at
+        checkpoint['delivery_count'] += exporter.stats['deliveries']
+        exporter.stats['deliveries'] = 0
+        redis_store.set(checkpoint_key(exam_id), dumps(checkpoint), ex=EXPORT_CHECKPOINT_TTL)
+
+    def on_page(has_next):
+        nonlocal pages, paused
+        pages += 1
+        # only stop for a new job when there is something left for it to do
+        if EXPORT_CHUNK_PAGES and pages >= EXPORT_CHUNK_PAGES and has_next:
+            paused = True
+        if paused or pages % EXPORT_CHECKPOINT_PAGES == 0:
+            save_checkpoint()
+        return paused
+
+    if checkpoint is None:
+        zip_filename = exam_id + '-' + exporter.filename.split('.')[0] + '.zip'
+        for _ in exporter.generate(get_buffer=buffers.get):
+            continue
+        delivery_count = exporter.stats['deliveries']
+    else:
+        zip_filename = checkpoint['zip_filename']
+        resumed = 'state' in checkpoint['entries']['cand']
+        try:
+            for _ in exporter.generate(get_buffer=buffers.get, headers=not resumed, on_page=on_page):
+                continue
+        except Exception:
+            if not redis_store.exists(checkpoint_key(exam_id)):
+                # failed before the first checkpoint, there is nothing to resume
+                shutil.rmtree(checkpoint['work_dir'], ignore_errors=True)
+            raise
+        if paused:
+            return False
+        delivery_count = checkpoint['delivery_count'] + exporter.stats['deliveries']
+
+    upload_file(integration_info, zip_filename, IterStream(archive))
+    if checkpoint is not None:
+        clear_checkpoint(checkpoint)
 
-    start = integration_info.get('last_timestamp')
-    end = datetime.utcnow().isoformat()
-    exporter = Exporter(exam_id, integration_info, 'all', start, end)
-
-    cand_filename = 'cand-' + exporter.filename
-    exam_filename = 'exam-' + exporter.filename
-    item_filename = 'item-' + exporter.filename
-    sect_filename = 'sect-' + exporter.filename
-    zip_filename = exam_id + '-' + exporter.filename.split('.')[0] + '.zip'
-
-    with TemporaryDirectory() as tempdirname:
-        cand_path = '{0}/{1}'.format(tempdirname, cand_filename)
-        exam_path = '{0}/{1}'.format(tempdirname, exam_filename)
-        item_path = '{0}/{1}'.format(tempdirname, item_filename)
-        sect_path = '{0}/{1}'.format(tempdirname, sect_filename)
-        zip_path = '{0}/{1}'.format(tempdirname, zip_filename)
-        with ZipFile(zip_path, 'w') as zip_file:
-            with \
-                codecs.open(cand_path, 'w', encoding='utf-8-sig') as cand_file, \
-                codecs.open(exam_path, 'w', encoding='utf-8-sig') as exam_file, \
-                codecs.open(item_path, 'w', encoding='utf-8-sig') as item_file, \
-                codecs.open(sect_path, 'w', encoding='utf-8-sig') as sect_file:
-                    def get_buffer(row_type):
-                        if row_type == 'cand':
-                            return cand_file
-                        
-                        if row_type == 'exam':
-                            return exam_file
-                        
-                        if row_type == 'item':
-                            return item_file
-                        
-                        if row_type == 'sect':
-                            return sect_file
-
-                    for _ in exporter.generate(get_buffer=get_buffer):
-                        continue
-            zip_file.write(cand_path, cand_filename)
-            zip_file.write(exam_path, exam_filename)
-            zip_file.write(item_path, item_filename)
-            zip_file.write(sect_path, sect_filename)
-        with MyFTP_TLS() as ftp:
-            ftp.connect(integration_info['sftp_host'], integration_info.get('sftp_port') or 21)
-            ftp.login(integration_info['sftp_user'], integration_info['sftp_password'])
-            ftp.prot_p()
-            with open(zip_path, 'rb') as zip_file:
-                try:
-                    ftp.storbinary('STOR ' + integration_info['sftp_path'] + zip_filename, zip_file, 1024)
-                except OSError:
-                    pass
+    # read again, the exam may have been configured while it was exporting
+    integration_info = get_integration_info(exam_id, fresh=True)
     if exporter.last_timestamp:
         integration_info['last_timestamp'] = exporter.last_timestamp
-    redis_store.set(exam_id, dumps(integration_info))
+    integration_info['last_delivery_count'] = delivery_count
+    save_integration_info(exam_id, integration_info)
+    return True
@@ -0,0 +1,181 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from json import loads, dumps
+from queue import Queue
+from tempfile import TemporaryFile
+from threading import Event, Lock
+
+from dateutil import parser, tz
+
+
+class PagePrefetcher:
+    """Iterates over the pages of a paginated SEI endpoint in order while the
+    next pages are already being fetched in the background.
+
+    fetch_page(page) returns the decoded json for a 1-indexed page and
+    page_count(data) returns the total number of pages if the response says
+    so, or None. At most `lookahead` pages are in flight past the one being
+    consumed (the caller holding on to a page is the backpressure), so memory
+    stays bounded however long the export is. Once the page count is known,
+    `fan_out` widens the window so that many page requests run at once.
+    """
+
+    def __init__(self, fetch_page, lookahead=2, fan_out=0, page_count=None):
+        self.fetch_page = fetch_page
+        self.lookahead = max(lookahead, 0)
+        self.fan_out = max(fan_out, 0)
+        self.page_count = page_count
+
+    def __iter__(self):
+        max_workers = max(self.lookahead, self.fan_out, 1)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = deque()
+            next_page = 1
+            last_page = None
+            window = self.lookahead
+            try:
+                while True:
+                    while len(pending) <= window and (last_page is None or next_page <= last_page):
+                        pending.append(executor.submit(self.fetch_page, next_page))
+                        next_page += 1
+                    if not pending:
+                        return
+
+                    data = pending.popleft().result()
+                    if last_page is None and self.page_count is not None:
+                        last_page = self.page_count(data)
+                        if last_page is not None:
+                            window = max(self.lookahead, self.fan_out)
+                    yield data
+
+                    if not data['has_next']:
+                        return
+            finally:
+                # pages requested past the end (or after the consumer stopped) are thrown away
+                for future in pending:
+                    future.cancel()
+
+
+def parse_timestamp(value):
+    """Parses an SEI timestamp into a naive UTC datetime."""
+    timestamp = parser.parse(value)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(tz.tzutc()).replace(tzinfo=None)
+    return timestamp
+
+
+def split_windows(start, end, count, overlap):
+    """Splits the time between start and end into `count` (after, before)
+    windows, each one starting `overlap` before the previous one ends so no
+    delivery modified right on a boundary is missed. The first window is
+    open at the start and the last one at the end."""
+    step = (end - start) / count
+    boundaries = [start + step * i for i in range(1, count)]
+    windows = []
+    after = None
+    for boundary in boundaries:
+        windows.append((after, boundary))
+        after = boundary - overlap
+    windows.append((after, None))
+    return windows
+
+
+class PageSpool:
+    """Pages fetched for one window, kept on disk until they are consumed."""
+
+    done = object()
+
+    def __init__(self):
+        self.file = TemporaryFile()
+        self.lock = Lock()
+        self.pages = Queue()
+
+    def put(self, data):
+        encoded = dumps(data).encode('utf-8')
+        with self.lock:
+            self.file.seek(0, os.SEEK_END)
+            position = self.file.tell()
+            self.file.write(encoded)
+        self.pages.put((position, len(encoded)))
+
+    def finish(self, error=None):
+        self.pages.put(error or self.done)
+
+    def __iter__(self):
+        while True:
+            item = self.pages.get()
+            if item is self.done:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            position, size = item
+            with self.lock:
+                self.file.seek(position)
+                encoded = self.file.read(size)
+            yield loads(encoded.decode('utf-8'))
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class WindowedPages:
+    """Iterates over the pages of deliveries in modified_at order, fetched a
+    time window at a time with every window being fetched at once.
+
+    fetch_page(page, window) returns the decoded json for a 1-indexed page of
+    the deliveries modified within `window`, an (after, before) pair of
+    datetimes where None leaves that end open. Pages of later windows are
+    spooled to disk until the earlier windows have been consumed. Windows
+    overlap a little, and deliveries a window shares with the one before it
+    are dropped.
+    """
+
+    def __init__(self, fetch_page, windows):
+        self.fetch_page = fetch_page
+        self.windows = windows
+
+    def fetch_window(self, window, spool, stop):
+        try:
+            page = 1
+            while not stop.is_set():
+                data = self.fetch_page(page, window)
+                spool.put(data)
+                if not data['has_next']:
+                    break
+                page += 1
+        except BaseException as e:
+            spool.finish(e)
+        else:
+            spool.finish()
+
+    def __iter__(self):
+        spools = [PageSpool() for _ in self.windows]
+        stop = Event()
+        with ThreadPoolExecutor(max_workers=len(self.windows)) as executor:
+            for window, spool in zip(self.windows, spools):
+                executor.submit(self.fetch_window, window, spool, stop)
+            try:
+                shared_ids = set()
+                for i, spool in enumerate(spools):
+                    next_after = self.windows[i + 1][0] if i + 1 < len(self.windows) else None
+                    next_shared_ids = set()
+                    for data in spool:
+                        if shared_ids:
+                            data['results'] = [delivery for delivery in data['results']
+                                               if delivery['id'] not in shared_ids]
+                        if i + 1 < len(spools):
+                            # the window's last page isn't the export's
+                            data['has_next'] = True
+                        if next_after is not None and data['results'] and \
+                                parse_timestamp(data['results'][-1]['modified_at']) >= next_after:
+                            next_shared_ids.update(delivery['id'] for delivery in data['results']
+                                                   if parse_timestamp(delivery['modified_at']) >= next_after)
+                        yield data
+                    shared_ids = next_shared_ids
+            finally:
+                stop.set()
+                # windows still being fetched stop after the page they are on
+                for spool in spools:
+                    spool.close()
@@ -0,0 +1,203 @@
+import codecs
+import os
+import struct
+import time
+import zlib
+from tempfile import SpooledTemporaryFile
+
+from config import TRANSFER_BLOCK_SIZE, ZIP_SPOOL_SIZE
+
+
+ZIP64_LIMIT = (1 << 31) - 1
+ZIP_MAX_ENTRIES = 0xFFFF
+
+LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+CENTRAL_HEADER = struct.Struct('<4s4B4HL2L5H2L')
+END_OF_CENTRAL_DIR = struct.Struct('<4s4H2LH')
+END_OF_CENTRAL_DIR_64 = struct.Struct('<4sQ2H2L4Q')
+END_OF_CENTRAL_DIR_64_LOCATOR = struct.Struct('<4sLQL')
+
+
+def dos_date_time(timestamp):
+    t = time.localtime(timestamp)
+    return (t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday, t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2
+
+
+class ZipEntry:
+    """One file in a StreamingZip.
+
+    Whatever is written is deflated straight away and only the compressed
+    bytes are kept, in memory up to ZIP_SPOOL_SIZE and on disk past that.
+    Text is encoded as it comes in, with a BOM in front when `bom` is set.
+
+    An entry given a `path` keeps its compressed bytes in that file instead,
+    so it can be checkpointed and later picked up again, possibly by another
+    process, from the `state` the checkpoint returned.
+    """
+
+    def __init__(self, name, bom=False, path=None, state=None):
+        self.name = name
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        self.closed = False
+        if state is None:
+            self.encoder = codecs.getincrementalencoder('utf-8-sig' if bom else 'utf-8')()
+            self.spool = SpooledTemporaryFile(max_size=ZIP_SPOOL_SIZE) if path is None else open(path, 'w+b')
+            self.crc = 0
+            self.file_size = 0
+            self.compress_size = 0
+            self.date, self.time = dos_date_time(time.time())
+        else:
+            # anything written after the checkpoint is thrown away and written again
+            self.encoder = codecs.getincrementalencoder('utf-8')()
+            self.spool = open(path, 'r+b')
+            self.spool.truncate(state['compress_size'])
+            self.spool.seek(0, os.SEEK_END)
+            self.crc = state['crc']
+            self.file_size = state['file_size']
+            self.compress_size = state['compress_size']
+            self.date, self.time = state['date'], state['time']
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = self.encoder.encode(data)
+        self.crc = zlib.crc32(data, self.crc)
+        self.file_size += len(data)
+        self.write_compressed(self.compressor.compress(data))
+        return len(data)
+
+    def write_compressed(self, data):
+        self.spool.write(data)
+        self.compress_size += len(data)
+
+    def checkpoint(self):
+        """Makes everything written so far durable and returns what is needed
+        to carry on from here.
+
+        A full flush ends the deflate stream on a byte boundary without any
+        references back into it, so a new compressor can append to it.
+        """
+        self.write_compressed(self.compressor.flush(zlib.Z_FULL_FLUSH))
+        self.spool.flush()
+        os.fsync(self.spool.fileno())
+        return {
+            'crc': self.crc,
+            'file_size': self.file_size,
+            'compress_size': self.compress_size,
+            'date': self.date,
+            'time': self.time,
+        }
+
+    def close(self):
+        if not self.closed:
+            self.write_compressed(self.compressor.flush())
+            self.spool.seek(0)
+            self.closed = True
+
+    @property
+    def zip64(self):
+        return self.file_size > ZIP64_LIMIT or self.compress_size > ZIP64_LIMIT
+
+    def local_header(self):
+        name = self.name.encode('utf-8')
+        if self.zip64:
+            extra = struct.pack('<2H2Q', 1, 16, self.file_size, self.compress_size)
+            version, compress_size, file_size = 45, 0xFFFFFFFF, 0xFFFFFFFF
+        else:
+            extra = b''
+            version, compress_size, file_size = 20, self.compress_size, self.file_size
+        return LOCAL_HEADER.pack(b'PK\x03\x04', version, 0, 0, zlib.DEFLATED, self.time, self.date, self.crc,
+                                 compress_size, file_size, len(name), len(extra)) + name + extra
+
+    def central_header(self, offset):
+        name = self.name.encode('utf-8')
+        if self.zip64 or offset > ZIP64_LIMIT:
+            extra = struct.pack('<2H3Q', 1, 24, self.file_size, self.compress_size, offset)
+            version, compress_size, file_size, offset = 45, 0xFFFFFFFF, 0xFFFFFFFF, 0xFFFFFFFF
+        else:
+            extra = b''
+            version, compress_size, file_size = 20, self.compress_size, self.file_size
+        return CENTRAL_HEADER.pack(b'PK\x01\x02', version, 3, version, 0, 0, zlib.DEFLATED, self.time, self.date,
+                                   self.crc, compress_size, file_size, len(name), len(extra), 0, 0, 0,
+                                   0o100644 << 16, offset) + name + extra
+
+    def iter_compressed(self, block_size):
+        while True:
+            block = self.spool.read(block_size)
+            if not block:
+                self.spool.close()
+                return
+            yield block
+
+
+class StreamingZip:
+    """A zip archive built from entries written side by side.
+
+    generate() writes its four files a few rows at a time each, so the
+    entries can't be laid out one after the other as they are written.
+    Instead each entry is compressed on its own and the archive is put
+    together from the compressed entries when iterated, block_size bytes
+    at a time, ready to be streamed out.
+    """
+
+    def __init__(self, block_size=TRANSFER_BLOCK_SIZE):
+        self.block_size = block_size
+        self.entries = []
+
+    def open(self, name, bom=False, path=None, state=None):
+        entry = ZipEntry(name, bom=bom, path=path, state=state)
+        self.entries.append(entry)
+        return entry
+
+    def close(self):
+        for entry in self.entries:
+            entry.close()
+
+    def __iter__(self):
+        self.close()
+        offset = 0
+        offsets = []
+        for entry in self.entries:
+            offsets.append(offset)
+            header = entry.local_header()
+            yield header
+            offset += len(header)
+            for block in entry.iter_compressed(self.block_size):
+                yield block
+            offset += entry.compress_size
+
+        central_dir = b''.join(entry.central_header(entry_offset)
+                               for entry, entry_offset in zip(self.entries, offsets))
+        yield central_dir + self.end_of_central_dir(len(central_dir), offset)
+
+    def end_of_central_dir(self, size, offset):
+        count = len(self.entries)
+        record = b''
+        if count > ZIP_MAX_ENTRIES or size > ZIP64_LIMIT or offset > ZIP64_LIMIT or \
+                any(entry.zip64 for entry in self.entries):
+            record = END_OF_CENTRAL_DIR_64.pack(b'PK\x06\x06', END_OF_CENTRAL_DIR_64.size - 12, 45, 45, 0, 0,
+                                                count, count, size, offset)
+            record += END_OF_CENTRAL_DIR_64_LOCATOR.pack(b'PK\x06\x07', 0, offset + size, 1)
+            count = min(count, ZIP_MAX_ENTRIES)
+            size = min(size, 0xFFFFFFFF)
+            offset = min(offset, 0xFFFFFFFF)
+        return record + END_OF_CENTRAL_DIR.pack(b'PK\x05\x06', 0, 0, count, count, size, offset, 0)
+
+
+class IterStream:
+    """A read-only file over an iterable of byte strings, for the FTP client
+    that reads what it uploads from a file."""
+
+    def __init__(self, iterable):
+        self.iterator = iter(iterable)
+        self.buffer = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.iterator)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
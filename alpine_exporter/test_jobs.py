@@ -0,0 +1,131 @@
+import io
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+
+import jobs
+from helpers import Exporter
+
+
+EXAM_ID = 'exam'
+PER_PAGE = 2
+
+
+class FakeRedis:
+    """The few redis commands write_fresh_data uses, kept in a dict."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def exists(self, key):
+        return key in self.data
+
+
+def make_delivery(index):
+    return {
+        'id': 'delivery{0}'.format(index),
+        'examinee_id': 'examinee{0}'.format(index),
+        'examinee': {'info': {'id': 'client{0}'.format(index)}},
+        'created_at': '2020-01-01T00:00:00',
+        'submitted_at': '2020-01-01T01:00:00',
+        'modified_at': '2020-01-02T00:00:{0:02d}'.format(index),
+        'used_seconds': 60,
+        'passed': True,
+        'score': 10,
+        'cutscore': {'score': 5},
+        'points_earned': 10,
+        'points_available': 10,
+        'rescored_at': None,
+        'form_id': 'form',
+        'item_responses': [],
+        'breakdown_objects': []
+    }
+
+
+class SEIExporter(Exporter):
+    """Exporter reading pages of `deliveries` the way SEI pages them."""
+
+    deliveries = []
+
+    def fetch_page(self, page, window=None):
+        deliveries = [delivery for delivery in self.deliveries
+                      if self.start is None or delivery['modified_at'] > self.start]
+        results = deliveries[(page - 1) * PER_PAGE:page * PER_PAGE]
+        return {'results': results, 'has_next': page * PER_PAGE < len(deliveries)}
+
+
+class ChunkedExportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.integration_info = {'token': 'token'}
+        self.uploads = []
+        work_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(work_dir.cleanup)
+
+        def create_exporter(exam_id, integration_info, type, start, end, output_format=None):
+            exporter = SEIExporter(exam_id, integration_info, type, start, end, exam_title='Exam',
+                                   output_format=output_format)
+            exporter.prefetch_pages = 0
+            exporter.backfill_windows = 0
+            exporter.processes = 0
+            return exporter
+
+        for name, value in [('redis_store', FakeRedis()),
+                            ('get_integration_info', lambda exam_id, fresh=False: dict(self.integration_info)),
+                            ('save_integration_info', self.save_integration_info),
+                            ('create_exporter', create_exporter),
+                            ('upload_file', self.upload_file),
+                            ('EXPORT_WORK_DIR', work_dir.name),
+                            ('EXPORT_CHECKPOINT_PAGES', 1)]:
+            patcher = mock.patch.object(jobs, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def save_integration_info(self, exam_id, integration_info):
+        self.integration_info = integration_info
+
+    def upload_file(self, integration_info, filename, file):
+        self.uploads.append(file.read())
+
+    def export(self, delivery_count, chunk_pages):
+        SEIExporter.deliveries = [make_delivery(index) for index in range(delivery_count)]
+        with mock.patch.object(jobs, 'EXPORT_CHUNK_PAGES', chunk_pages):
+            for jobs_run in range(1, 10):
+                if jobs.write_fresh_data(EXAM_ID):
+                    return jobs_run
+        self.fail('the export never finished')
+
+    def exported_ids(self):
+        archive = zipfile.ZipFile(io.BytesIO(self.uploads[-1]))
+        name = [name for name in archive.namelist() if name.startswith('exam-')][0]
+        rows = archive.read(name).decode('utf-8-sig').splitlines()[1:]
+        return [row.split(',')[0] for row in rows]
+
+    def test_finishes_when_pages_fill_the_last_chunk(self):
+        self.assertEqual(self.export(PER_PAGE * 2, chunk_pages=1), 2)
+        self.assertEqual(self.exported_ids(), ['delivery0', 'delivery1', 'delivery2', 'delivery3'])
+        self.assertEqual(self.integration_info['last_delivery_count'], 4)
+
+    def test_finishes_in_one_job_when_the_chunk_holds_every_page(self):
+        self.assertEqual(self.export(PER_PAGE * 2, chunk_pages=2), 1)
+        self.assertEqual(len(self.exported_ids()), 4)
+
+    def test_carries_on_in_new_jobs(self):
+        self.assertEqual(self.export(PER_PAGE * 2 + 1, chunk_pages=1), 3)
+        self.assertEqual(len(self.exported_ids()), 5)
+        self.assertEqual(self.integration_info['last_timestamp'], '2020-01-02T00:00:04')
+
+
+if __name__ == '__main__':
+    unittest.main()
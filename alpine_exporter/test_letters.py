@@ -0,0 +1,55 @@
+import unittest
+
+from helpers import list_to_alpha, response_to_alpha
+
+
+# (final, option count): letters, as the export has always written them. Each
+# option past the 25th repeats its letter once more for every 25 options
+RESPONSES = {
+    (None, 4): '',
+    ((), 4): '',
+    ((0,), 4): 'A',
+    ((0, 2), 4): 'AC',
+    ((2, 0), 4): 'AC',
+    ((1, 1), 4): 'B',
+    ((3,), 4): 'D',
+    ((24,), 26): 'Y',
+    ((25,), 26): 'AA',
+    ((0, 25), 26): 'AAA',
+    ((59,), 60): 'JJJ',
+    ((299,), 300): 'YYYYYYYYYYYY',
+    ((True, 1.0, 2), 4): 'BC',
+    (('0', 1), 4): 'B',
+    ((0,), 0): '',
+}
+
+# answer keys: letters
+KEYS = {
+    (1, 0, 1): 'AC',
+    (0, 0): '',
+    (): '',
+    (1, 1, 1): 'ABC',
+    (0,) * 25 + (1,): 'AA',
+    (0,) * 50 + (1,): 'AAA',
+}
+
+
+class ResponseLettersTest(unittest.TestCase):
+
+    def test_response_letters(self):
+        for (final, option_count), letters in RESPONSES.items():
+            final = None if final is None else list(final)
+            self.assertEqual(response_to_alpha(final, option_count), letters, (final, option_count))
+
+    def test_key_letters(self):
+        for key, letters in KEYS.items():
+            self.assertEqual(list_to_alpha(list(key)), letters, key)
+
+    def test_ignores_indexes_past_the_options(self):
+        self.assertEqual(response_to_alpha([4, -1], 4), '')
+        self.assertEqual(response_to_alpha([2 ** 40, 0, -2 ** 40], 4), 'A')
+        self.assertEqual(response_to_alpha([10 ** 18, 299], 300), 'YYYYYYYYYYYY')
+
+
+if __name__ == '__main__':
+    unittest.main()
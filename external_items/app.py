@@ -1,5 +1,3 @@
-from json import dumps
-
 import requests
 from flask import Flask, render_template, request, abort
 from requests.auth import HTTPBasicAuth
@@ -8,7 +6,7 @@ from werkzeug.contrib.fixers import ProxyFix
 from colorblind.views import colorblind_bp
 from connect4.views import connect4_bp
 from adventure.views import adventure_bp
-from helpers import redis_store
+from helpers import save_integration_info
 
 # app setup
 app = Flask(__name__)
@@ -39,5 +37,5 @@ def sei_redirect():
     if resp.status_code != 200:
         abort(400)
     data = resp.json()
-    redis_store.set(data['exam_id'], dumps(data))
+    save_integration_info(data['exam_id'], data)
     return render_template('sei_redirect.html')
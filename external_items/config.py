@@ -9,3 +9,7 @@ SEI_ID = os.environ.get('SEI_ID')
 SEI_SECRET = os.environ.get('SEI_SECRET')
 
 REDIS_URL = os.environ.get('REDIS_URL', 'redis://redis:6379')
+
+# integration info is cached in each process (exams, seconds) in front of redis
+INTEGRATION_CACHE_SIZE = int(os.environ.get('INTEGRATION_CACHE_SIZE', '1000'))
+INTEGRATION_CACHE_TTL = int(os.environ.get('INTEGRATION_CACHE_TTL', '30'))
@@ -1,16 +1,21 @@
 from redis import StrictRedis
-from config import REDIS_URL, SECRET_KEY, SEI_URL_BASE, SEI_ID, SEI_SECRET
+from config import REDIS_URL, SECRET_KEY, SEI_URL_BASE, SEI_ID, SEI_SECRET, INTEGRATION_CACHE_SIZE, \
+    INTEGRATION_CACHE_TTL
 from itsdangerous import URLSafeTimedSerializer
 import requests
 from requests.auth import HTTPBasicAuth
 from json import loads, dumps
+from caches import TTLCache
 
 
 redis_store = StrictRedis.from_url(REDIS_URL, db=4, decode_responses=True)
 external_serializer = URLSafeTimedSerializer(SECRET_KEY)
 
 
-def get_integration_info(exam_id):
+integration_info_cache = TTLCache(INTEGRATION_CACHE_SIZE, INTEGRATION_CACHE_TTL, name='integration_info')
+
+
+def load_integration_info(exam_id):
     data = redis_store.get(exam_id)
     if data:
         return loads(data)
@@ -21,3 +26,18 @@ def get_integration_info(exam_id):
     data = resp.json()
     redis_store.set(data['exam_id'], dumps(data))
     return data
+
+
+def get_integration_info(exam_id, fresh=False):
+    # fresh=True skips the cached copy, for callers that change and save it
+    if fresh:
+        data = load_integration_info(exam_id)
+        integration_info_cache.set(exam_id, data)
+    else:
+        data = integration_info_cache.get(exam_id, load_integration_info)
+    return dict(data)
+
+
+def save_integration_info(exam_id, data):
+    redis_store.set(exam_id, dumps(data))
+    integration_info_cache.set(exam_id, dict(data))
@@ -1,4 +1,5 @@
 import io
+import socket
 from datetime import datetime, timedelta
 from json import loads, dumps
 from multiprocessing.dummy import Pool as ThreadPool
@@ -6,14 +7,20 @@ from multiprocessing.dummy import Pool as ThreadPool
 import requests
 import jwt
 import paramiko
+from paramiko.ssh_exception import NoValidConnectionsError
 from flask import Flask, render_template, request, abort, jsonify, redirect, url_for
 from flask_wtf import FlaskForm
 from redis import StrictRedis
 from requests.auth import HTTPBasicAuth
+from rq import get_current_job
+from rq.decorators import job
+from rq_scheduler import Scheduler
 from werkzeug.contrib.fixers import ProxyFix
 from wtforms import StringField, IntegerField
 from wtforms.validators import Optional, ValidationError
 
+from caches import TTLCache, TokenCache
+
 
 # app setup
 app = Flask(__name__)
@@ -25,10 +32,15 @@ app.url_map.strict_slashes = False
 
 # some helpers
 redis_store = StrictRedis.from_url(app.config['REDIS_URL'], db=app.config['REDIS_DB'], decode_responses=True)
+rq_store = StrictRedis.from_url(app.config['REDIS_URL'], db=app.config['REDIS_DB'])
 pool = ThreadPool(4)
 
 
-def get_integration_info(exam_id):
+integration_info_cache = TTLCache(app.config['INTEGRATION_CACHE_SIZE'], app.config['INTEGRATION_CACHE_TTL'],
+                                  name='integration_info')
+
+
+def load_integration_info(exam_id):
     data = redis_store.get(exam_id)
     if data:
         return loads(data)
@@ -41,6 +53,24 @@ def get_integration_info(exam_id):
     return data
 
 
+def get_integration_info(exam_id, fresh=False):
+    # fresh=True skips the cached copy, for callers that change and save it
+    if fresh:
+        data = load_integration_info(exam_id)
+        integration_info_cache.set(exam_id, data)
+    else:
+        data = integration_info_cache.get(exam_id, load_integration_info)
+    return dict(data)
+
+
+def save_integration_info(exam_id, data):
+    redis_store.set(exam_id, dumps(data))
+    integration_info_cache.set(exam_id, dict(data))
+
+
+token_cache = TokenCache(app.config['JWT_CACHE_SIZE'])
+
+
 class ConfigureForm(FlaskForm):
     sftp_host = StringField('SFTP Host')
     sftp_port = IntegerField('SFTP Port', default=22)
@@ -84,6 +114,85 @@ def build_columns_and_data(delivery_json):
     return columns, data
 
 
+def should_retry(error, attempt):
+    """Whether a failed job is worth trying again: only connection problems
+    and 5xx or 429 answers, and only JOB_RETRIES times. SFTP connection
+    problems are retried too, failed logins aren't."""
+    if attempt >= app.config['JOB_RETRIES']:
+        return False
+    if isinstance(error, requests.HTTPError):
+        status_code = error.response.status_code if error.response is not None else 0
+        return status_code >= 500 or status_code == 429
+    if isinstance(error, paramiko.AuthenticationException):
+        return False
+    if isinstance(error, (paramiko.SSHException, NoValidConnectionsError, socket.timeout)):
+        return True
+    return isinstance(error, requests.RequestException)
+
+
+def retry_later(attempt, func, *args, **kwargs):
+    """Schedules the job again on the queue it came from, after
+    JOB_RETRY_BACKOFF seconds and twice as long each attempt after. The
+    scheduler (python scheduler.py) moves it onto the queue when it's due."""
+    current_job = get_current_job()
+    queue_name = current_job.origin if current_job else app.config['QUEUES'][0]
+    scheduler = Scheduler(queue_name=queue_name, connection=rq_store)
+    delay = timedelta(seconds=app.config['JOB_RETRY_BACKOFF'] * 2 ** attempt)
+    scheduler.enqueue_in(delay, func, *args, attempt=attempt + 1, **kwargs)
+
+
+def send_delivery(exam_id, delivery_id, received_at):
+    integration_info = get_integration_info(exam_id)
+    sftp_host = integration_info.get('sftp_host')
+    if not sftp_host:
+        return
+
+    # get full delivery object from SEI
+    delivery_url = '{0}/api/exams/{1}/deliveries/{2}?include=exam,form'.format(app.config['SEI_URL_BASE'], exam_id, delivery_id)
+    delivery_headers = {'Authorization': 'Bearer {0}'.format(integration_info['token'])}
+    delivery_response = requests.get(delivery_url, headers=delivery_headers)
+    delivery_response.raise_for_status()
+    delivery_json = delivery_response.json()
+
+    # format the data into lists
+    columns, data = build_columns_and_data(delivery_json)
+
+    # write the lists to a tab delimited string
+    output_str = '\t'.join(columns) + '\n' + '\t'.join(data) + '\n'
+    output_file = io.StringIO(output_str)
+
+    filename = '{}-{}.txt'.format(delivery_id, received_at)
+
+    sftp_path = integration_info.get('sftp_path', '')
+    if sftp_path:
+        sftp_path.strip('/')
+        filename = '{}/{}'.format(sftp_path, filename)
+
+    sftp_user = integration_info.get('sftp_user')
+    sftp_password = integration_info.get('sftp_password')
+    sftp_port = integration_info.get('sftp_port') or 22
+
+    ssh_client = paramiko.SSHClient()
+    ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    try:
+        ssh_client.connect(hostname=sftp_host, username=sftp_user, password=sftp_password, port=sftp_port)
+        ftp_client = ssh_client.open_sftp()
+        ftp_client.putfo(output_file, filename)
+        ftp_client.close()
+    finally:
+        ssh_client.close()
+
+
+@job('default', connection=rq_store)
+def upload_delivery(exam_id, delivery_id, received_at, attempt=0):
+    try:
+        send_delivery(exam_id, delivery_id, received_at)
+    except Exception as e:
+        if not should_retry(e, attempt):
+            raise
+        retry_later(attempt, upload_delivery, exam_id, delivery_id, received_at)
+
+
 # views
 @app.route('/')
 def index():
@@ -107,7 +216,7 @@ def sei_redirect():
         existing_data = loads(existing_data)
         existing_data.update(data)
         data = existing_data
-    redis_store.set(exam_id, dumps(data))
+    save_integration_info(exam_id, data)
     now = datetime.utcnow()
     exp_seconds = 3600
     exp_time = (now + timedelta(seconds=exp_seconds))
@@ -126,7 +235,7 @@ def delivery_completed():
     auth_header = request.headers.get('Authorization')
     token = auth_header.split()[1]
     try:
-        decoded = jwt.decode(token, integration_info['secret'], algorithms=['HS256'])
+        decoded = token_cache.decode(token, integration_info['secret'])
     except jwt.exceptions.InvalidTokenError:
         return jsonify(), 403
 
@@ -134,40 +243,8 @@ def delivery_completed():
     if not sftp_host:
         return jsonify(), 403
 
-    # get full delivery object from SEI
-    delivery_id = body['delivery_id']
-    delivery_url = '{0}/api/exams/{1}/deliveries/{2}?include=exam,form'.format(app.config['SEI_URL_BASE'], exam_id, delivery_id)
-    delivery_headers = {'Authorization': 'Bearer {0}'.format(integration_info['token'])}
-    delivery_response = requests.get(delivery_url, headers=delivery_headers)
-    delivery_json = delivery_response.json()
-
-    # format the data into lists
-    columns, data = build_columns_and_data(delivery_json)
-
-    # write the lists to a tab delimited string
-    output_str = '\t'.join(columns) + '\n' + '\t'.join(data) + '\n'
-    output_file = io.StringIO(output_str)
-
-    filename = '{}-{}.txt'.format(delivery_id, datetime.utcnow().isoformat())
-
-    sftp_path = integration_info.get('sftp_path', '')
-    if sftp_path:
-        sftp_path.strip('/')
-        filename = '{}/{}'.format(sftp_path, filename)
-
-    sftp_user = integration_info.get('sftp_user')
-    sftp_password = integration_info.get('sftp_password')
-    sftp_port = integration_info.get('sftp_port') or 22
-
-    ssh_client = paramiko.SSHClient()
-    ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh_client.connect(hostname=sftp_host, username=sftp_user, password=sftp_password, port=sftp_port)
-
-    ftp_client = ssh_client.open_sftp()
-    ftp_client.putfo(output_file, filename)
-    ftp_client.close()
-    ssh_client.close()
-
+    # the file is uploaded by a worker, so SEI isn't kept waiting
+    upload_delivery.delay(exam_id, body['delivery_id'], datetime.utcnow().isoformat())
     return jsonify()
 
 
@@ -178,7 +255,7 @@ def delivery_widget():
     token = request.args.get('jwt')
     integration_info = get_integration_info(exam_id)
     try:
-        decoded = jwt.decode(token, integration_info['secret'], algorithms=['HS256'])
+        decoded = token_cache.decode(token, integration_info['secret'])
     except jwt.exceptions.InvalidTokenError:
         abort(403)
     configs = integration_info.get('configs', [])
@@ -195,9 +272,9 @@ def delivery_widget():
 def configure():
     exam_id = request.args.get('exam_id')
     token = request.args.get('jwt')
-    integration_info = get_integration_info(exam_id)
+    integration_info = get_integration_info(exam_id, fresh=True)
     try:
-        decoded = jwt.decode(token, integration_info['secret'], algorithms=['HS256'])
+        decoded = token_cache.decode(token, integration_info['secret'])
     except jwt.exceptions.InvalidTokenError:
         abort(403)
     form = ConfigureForm(**integration_info)
@@ -207,7 +284,7 @@ def configure():
         integration_info['sftp_user'] = form.sftp_user.data
         integration_info['sftp_password'] = form.sftp_password.data
         integration_info['sftp_path'] = form.sftp_path.data
-        redis_store.set(exam_id, dumps(integration_info))
+        save_integration_info(exam_id, integration_info)
         return redirect(url_for('complete'))
     return render_template('configure.html', exam_id=exam_id, token=token, form=form)
 
@@ -13,3 +13,16 @@ REDIS_URL = os.environ.get('REDIS_URL', 'redis://redis:6379')
 REDIS_DB = int(os.environ.get('REDIS_DB', '1'))
 
 QUEUES = loads(os.environ.get('QUEUES', '["default", "low"]'))
+
+# integration info is cached in each process (exams, seconds) in front of redis
+INTEGRATION_CACHE_SIZE = int(os.environ.get('INTEGRATION_CACHE_SIZE', '1000'))
+INTEGRATION_CACHE_TTL = int(os.environ.get('INTEGRATION_CACHE_TTL', '30'))
+
+# tokens that passed verification are remembered until they expire (count)
+JWT_CACHE_SIZE = int(os.environ.get('JWT_CACHE_SIZE', '10000'))
+
+# jobs that fail on a connection problem or a 5xx/429 answer are scheduled
+# again JOB_RETRIES times, JOB_RETRY_BACKOFF seconds later and twice as long
+# each time after, before landing in rq's failed queue
+JOB_RETRIES = int(os.environ.get('JOB_RETRIES', '3'))
+JOB_RETRY_BACKOFF = int(os.environ.get('JOB_RETRY_BACKOFF', '5'))
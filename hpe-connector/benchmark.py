@@ -0,0 +1,110 @@
+"""Cold start timings for the handlers, each run in a fresh interpreter.
+
+    python benchmark.py --repeat 5
+    python benchmark.py --invoke
+
+Without --invoke nothing leaves the machine: it times importing the
+handler, creating the S3 client and importing jinja2 (all of which used
+to happen at import), and loading and rendering the delivery widget
+template from templates/ and precompiled (run compile_templates.py
+first). With --invoke each handler's first call with event.json is timed
+too, which needs STAGE. The credentials are stubbed: the token in
+event.json doesn't match their secret, so handle_sei_event answers 403
+before anything is sent to SEI, PSI, Saba or Slack, and the widget gets a
+token signed with it so the template is rendered.
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+
+COLD_START = '''
+import json
+import sys
+import time
+
+timings = {}
+start = time.perf_counter()
+import handler
+timings['import handler'] = time.perf_counter() - start
+
+start = time.perf_counter()
+handler.get_s3()
+timings['first S3 client'] = time.perf_counter() - start
+
+start = time.perf_counter()
+import jinja2
+timings['import jinja2'] = time.perf_counter() - start
+
+if sys.argv[1] == 'source':
+    handler.COMPILED_TEMPLATES_DIR = 'no_compiled_templates'
+start = time.perf_counter()
+handler.get_jinja_env().get_template('delivery_widget.html').render(exam_id='e', delivery_id='d', token='t', stage='s')
+timings['first widget render (' + sys.argv[1] + ')'] = time.perf_counter() - start
+print(json.dumps(timings))
+'''
+
+FIRST_INVOCATION = '''
+import json
+import sys
+import time
+
+import jwt
+
+import handler
+
+SECRET = 'benchmark secret, long enough for HS256'
+EXPECTED_STATUS = {'handle_sei_event': 403, 'handle_delivery_widget': 200}
+
+with open('event.json') as f:
+    event = json.load(f)
+args = event['queryStringParameters']
+handler.get_credentials_dict = lambda: {args['exam_id']: {'secret': SECRET, 'token': 'benchmark'}}
+args['jwt'] = jwt.encode({'exam_id': args['exam_id']}, SECRET, algorithm='HS256')
+
+start = time.perf_counter()
+response = getattr(handler, sys.argv[1])(event, None)
+seconds = time.perf_counter() - start
+if response['statusCode'] != EXPECTED_STATUS[sys.argv[1]]:
+    sys.exit('{0} answered {1}'.format(sys.argv[1], response['statusCode']))
+print(json.dumps({'first ' + sys.argv[1]: seconds}))
+'''
+
+
+def run(code, *args):
+    output = subprocess.check_output([sys.executable, '-c', code] + list(args))
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def collect(repeat, code, *args):
+    timings = {}
+    for _ in range(repeat):
+        for name, seconds in run(code, *args).items():
+            timings.setdefault(name, []).append(seconds)
+    return timings
+
+
+def report(timings):
+    for name, seconds in timings.items():
+        print('{0:<40} {1:8.1f}ms {2:8.1f}ms'.format(name, min(seconds) * 1000, statistics.median(seconds) * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--invoke', action='store_true', help='also time the first call of each handler')
+    args = parser.parse_args()
+
+    print('{0:<40} {1:>10} {2:>10}'.format('', 'best', 'median'))
+    report(collect(args.repeat, COLD_START, 'source'))
+    report({name: seconds for name, seconds in collect(args.repeat, COLD_START, 'compiled').items()
+            if 'render' in name})
+    if args.invoke:
+        for name in ['handle_sei_event', 'handle_delivery_widget']:
+            report(collect(args.repeat, FIRST_INVOCATION, name))
+
+
+if __name__ == '__main__':
+    main()
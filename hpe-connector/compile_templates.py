@@ -0,0 +1,28 @@
+"""Compiles the templates to python modules, so a cold start of the
+delivery widget doesn't parse and compile them.
+
+    python compile_templates.py
+
+npm run deploy runs this before deploying. The handler only uses the
+compiled templates with the jinja2 version that compiled them and falls
+back to templates/ otherwise, so run it again after changing a template.
+"""
+import os
+import shutil
+
+import jinja2
+
+from handler import TEMPLATES_DIR, COMPILED_TEMPLATES_DIR, create_jinja_env
+
+
+def main():
+    shutil.rmtree(COMPILED_TEMPLATES_DIR, ignore_errors=True)
+    env = create_jinja_env(jinja2.FileSystemLoader(TEMPLATES_DIR))
+    env.compile_templates(COMPILED_TEMPLATES_DIR, zip=None, ignore_errors=False)
+    with open(os.path.join(COMPILED_TEMPLATES_DIR, 'jinja2_version'), 'w') as f:
+        f.write(jinja2.__version__)
+    print('compiled {0} templates with jinja2 {1}'.format(len(env.list_templates()), jinja2.__version__))
+
+
+if __name__ == '__main__':
+    main()
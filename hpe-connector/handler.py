@@ -1,19 +1,71 @@
 import json
+import logging
 import os
+import re
+import time
+from concurrent import futures
 from datetime import datetime
+from threading import Lock, local
+from urllib.parse import quote
 
-import boto3
 import jwt
 import requests
-from jinja2 import Environment, FileSystemLoader, select_autoescape
 from requests.auth import HTTPBasicAuth
 
-
-s3 = boto3.client('s3')
-env = Environment(
-    loader=FileSystemLoader('templates'),
-    autoescape=select_autoescape(['html', 'xml'])
-)
+from caches import TTLCache
+
+
+# each http request gets REQUEST_TIMEOUT seconds and each downstream call
+# CALL_TIMEOUT seconds, by default enough for the longest run of requests one
+# after the other in a call: Saba login, person lookup and transcript, and
+# logging in again and retrying one of them when Saba rejects the certificate.
+# No Saba request is started once its call is out of time, so a call given up
+# on doesn't hold on to the pool (kept across warm invocations) for long after
+SABA_CALL_REQUESTS = 5
+REQUEST_TIMEOUT = float(os.environ.get('REQUEST_TIMEOUT', '3'))
+CALL_TIMEOUT = float(os.environ.get('CALL_TIMEOUT', str(SABA_CALL_REQUESTS * REQUEST_TIMEOUT)))
+call_deadline = local()
+executor = futures.ThreadPoolExecutor(max_workers=int(os.environ.get('DISPATCH_WORKERS', '8')))
+
+# the Saba course lookup runs next to the person lookup in a pool of its own,
+# since send_to_saba itself runs on the pool above
+lookup_executor = futures.ThreadPoolExecutor(max_workers=int(os.environ.get('LOOKUP_WORKERS', '4')))
+
+# handle_batch works on BATCH_WORKERS deliveries at a time, in its own pool
+# since each delivery hands work to the one above
+batch_executor = futures.ThreadPoolExecutor(max_workers=int(os.environ.get('BATCH_WORKERS', '8')))
+
+# the credentials, PSI token and Saba certificate are kept across warm
+# invocations (a PSI token until PSI_TOKEN_MARGIN seconds before it expires)
+# and CACHE_STATS counts how often they could be reused
+PSI_TOKEN_MARGIN = int(os.environ.get('PSI_TOKEN_MARGIN', '60'))
+CACHE_STATS = {name: {'hits': 0, 'misses': 0} for name in ['credentials', 'psi_token', 'saba_cert']}
+cached_credentials = None
+cached_psi_token = None
+cached_saba_cert = None
+psi_token_lock = Lock()
+saba_cert_lock = Lock()
+
+# saba people and courses found are kept LOOKUP_CACHE_TTL seconds (at most
+# LOOKUP_CACHE_SIZE of each), and in S3 as well when LOOKUP_CACHE_S3 is set
+LOOKUP_CACHE_SIZE = int(os.environ.get('LOOKUP_CACHE_SIZE', '1000'))
+LOOKUP_CACHE_TTL = int(os.environ.get('LOOKUP_CACHE_TTL', '3600'))
+LOOKUP_CACHE_S3 = os.environ.get('LOOKUP_CACHE_S3', '').lower() in ('1', 'true', 'yes')
+
+# exams are named after their saba course, e.g. 'HPE1-H01 Selling HPE Solutions';
+# those that aren't, or whose course isn't found, are credited to
+# SABA_DEFAULT_COURSE_ID (set it empty to report them as failed instead)
+COURSE_NO_PATTERN = re.compile(r'^\s*([A-Z0-9]+-[A-Z0-9]+)\b')
+SABA_DEFAULT_COURSE_ID = os.environ.get('SABA_DEFAULT_COURSE_ID', 'cours000000001189168')
+
+# boto3 and jinja2 are only loaded once a handler needs them, and templates
+# are loaded from COMPILED_TEMPLATES_DIR when compile_templates.py has been run
+TEMPLATES_DIR = 'templates'
+COMPILED_TEMPLATES_DIR = 'compiled_templates'
+s3_client = None
+jinja_env = None
+
+logger = logging.getLogger(__name__)
 
 
 def handle_sei_event(event, context):
@@ -38,16 +90,15 @@ def handle_sei_event(event, context):
     delivery_id = body['delivery_id']
     delivery_json = get_delivery_json(exam_id, delivery_id, token)
 
-    # TODO: run these in parallel
-    psi_response = send_to_psi(delivery_json)
-
-    saba_response = None
+    calls = {
+        'psi': (send_to_psi, delivery_json),
+        'ip': (check_ip,),
+    }
     if delivery_json['passed']:
-        saba_response = send_to_saba(delivery_json)
-
-    ip_response = check_ip()
+        calls['saba'] = (send_to_saba, delivery_json)
+    results = dispatch(calls)
 
-    send_to_slack(delivery_json, psi_response, saba_response, ip_response)
+    send_to_slack(delivery_json, results['psi'], results.get('saba'), results['ip'])
 
     response = {
         'statusCode': 200,
@@ -57,6 +108,62 @@ def handle_sei_event(event, context):
     return response
 
 
+def handle_batch(event, context):
+    """Sends a backlog of deliveries to PSI and Saba again, e.g. after an
+    outage, and posts one summary to Slack.
+
+    The event is either {'exam_id': ..., 'delivery_ids': [...]} when invoked
+    directly, or a batch of SQS records whose bodies are SEI event bodies.
+    It isn't exposed over http, so there is no SEI token to check. For SQS
+    the records that failed are returned so only those are retried.
+    """
+    if 'Records' in event:
+        items = []
+        for record in event['Records']:
+            body = json.loads(record['body'])
+            items.append((record['messageId'], body['exam_id'], body['delivery_id']))
+    else:
+        items = [(delivery_id, event['exam_id'], delivery_id) for delivery_id in event['delivery_ids']]
+
+    credentials = get_credentials_dict()
+    pending = [(item_id, delivery_id, batch_executor.submit(resend_delivery, exam_id, delivery_id, credentials))
+               for item_id, exam_id, delivery_id in items]
+
+    results = {}
+    failures = []
+    for item_id, delivery_id, future in pending:
+        try:
+            results[delivery_id] = future.result()
+        except Exception as e:
+            results[delivery_id] = {'Error': repr(e)}
+        if not delivered(results[delivery_id]):
+            failures.append({'itemIdentifier': item_id})
+
+    send_batch_to_slack(results, len(failures))
+
+    if 'Records' in event:
+        return {'batchItemFailures': failures}
+    return {'deliveries': len(results), 'failed': len(failures), 'results': results}
+
+
+def resend_delivery(exam_id, delivery_id, credentials):
+    delivery_json = get_delivery_json(exam_id, delivery_id, credentials[exam_id]['token'])
+    result = {'PSI': send_to_psi(delivery_json)['Status Code']}
+    if delivery_json['passed']:
+        saba_response = send_to_saba(delivery_json)
+        result['SABA'] = saba_response['Status Code']
+        if 'Error' in saba_response:
+            result['SABA Error'] = saba_response['Error']
+    return result
+
+
+def delivered(result):
+    # PSI, and Saba for passed deliveries, both answered with a 2xx; a missing
+    # Saba person or course has no status code
+    codes = [result[name] for name in ('PSI', 'SABA') if name in result]
+    return bool(codes) and all(code is not None and 200 <= code < 300 for code in codes)
+
+
 def handle_delivery_widget(event, context):
     args = event['queryStringParameters']
     exam_id = args['exam_id']
@@ -74,7 +181,7 @@ def handle_delivery_widget(event, context):
         }
         return response
 
-    template = env.get_template('delivery_widget.html')
+    template = get_jinja_env().get_template('delivery_widget.html')
     content = template.render(exam_id=exam_id, delivery_id=delivery_id, token=token, stage=stage)
 
     response = {
@@ -87,6 +194,70 @@ def handle_delivery_widget(event, context):
     return response
 
 
+def get_s3():
+    global s3_client
+    if s3_client is None:
+        import boto3
+        s3_client = boto3.client('s3')
+    return s3_client
+
+
+def get_jinja_env():
+    global jinja_env
+    if jinja_env is None:
+        import jinja2
+        if compiled_templates_version() == jinja2.__version__:
+            jinja_env = create_jinja_env(jinja2.ModuleLoader(COMPILED_TEMPLATES_DIR))
+        else:
+            jinja_env = create_jinja_env(jinja2.FileSystemLoader(TEMPLATES_DIR))
+    return jinja_env
+
+
+def create_jinja_env(loader):
+    from jinja2 import Environment, select_autoescape
+    return Environment(loader=loader, autoescape=select_autoescape(['html', 'xml']))
+
+
+def compiled_templates_version():
+    # compiled templates only work with the jinja2 they were compiled by
+    try:
+        with open(os.path.join(COMPILED_TEMPLATES_DIR, 'jinja2_version')) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def dispatch(calls, timeout=CALL_TIMEOUT):
+    """Runs independent calls at the same time and returns their results by
+    name. A call that fails or takes longer than `timeout` seconds gets an
+    error in place of its result, so the others are still reported."""
+    started = time.monotonic()
+    pending = {name: executor.submit(run_until, started + timeout, *call) for name, call in calls.items()}
+    results = {}
+    for name, future in pending.items():
+        try:
+            results[name] = future.result(timeout=max(0, started + timeout - time.monotonic()))
+        except futures.TimeoutError:
+            results[name] = {'Error': 'timed out after {} seconds'.format(timeout)}
+        except Exception as e:
+            results[name] = {'Error': repr(e)}
+    return results
+
+
+def run_until(deadline, func, *args):
+    # makes the deadline dispatch gives a call available to time_left()
+    call_deadline.at = deadline
+    try:
+        return func(*args)
+    finally:
+        call_deadline.at = None
+
+
+def time_left():
+    deadline = getattr(call_deadline, 'at', None)
+    return float('inf') if deadline is None else deadline - time.monotonic()
+
+
 def authorize_sei_event(token, secret):
     try:
         jwt.decode(token, secret, algorithms=['HS256'])
@@ -95,29 +266,118 @@ def authorize_sei_event(token, secret):
         return False
 
 
+def count_cache(name, hit):
+    CACHE_STATS[name]['hits' if hit else 'misses'] += 1
+
+
+def cache_stats():
+    stats = {}
+    for name, counts in CACHE_STATS.items():
+        total = counts['hits'] + counts['misses']
+        stats[name] = dict(counts, hit_rate=round(counts['hits'] / total, 2) if total else None)
+    for cache in (saba_people, saba_courses):
+        stats[cache.name] = cache.stats()
+    return stats
+
+
+class LookupCache(TTLCache):
+    """Saba lookups kept across warm invocations. With `shared` set they are
+    also kept in S3 until they expire, so cold containers and other functions
+    find them; one found there is kept here for `ttl` from then."""
+
+    def __init__(self, name, max_size=LOOKUP_CACHE_SIZE, ttl=LOOKUP_CACHE_TTL, shared=LOOKUP_CACHE_S3):
+        super().__init__(max_size, ttl, name=name)
+        self.shared = shared
+
+    def load(self, key, load):
+        if not self.shared:
+            return super().load(key, load)
+        value = self.get_shared(key)
+        if value is not None:
+            self.count(hit=True)
+            self.set(key, value)
+            return value
+        value = super().load(key, load)
+        if value is not None:
+            self.set_shared(key, value)
+        return value
+
+    def shared_key(self, key):
+        return 'hpe/{}/lookups/{}/{}.json'.format(os.environ['STAGE'], self.name, quote(key, safe=''))
+
+    def get_shared(self, key):
+        s3 = get_s3()
+        try:
+            data = s3.get_object(Bucket='caveon-private', Key=self.shared_key(key))
+        except s3.exceptions.ClientError:
+            return None
+        entry = json.loads(data['Body'].read())
+        if entry['expires_at'] < time.time():
+            return None
+        return entry['value']
+
+    def set_shared(self, key, value):
+        body = json.dumps({'expires_at': time.time() + self.ttl, 'value': value})
+        s3 = get_s3()
+        try:
+            s3.put_object(Bucket='caveon-private', Key=self.shared_key(key), Body=body)
+        except s3.exceptions.ClientError:
+            # the lookup is still cached here, other containers look it up themselves
+            logger.warning('could not save %s %s to S3', self.name, key, exc_info=True)
+
+
+saba_people = LookupCache('saba_person')
+saba_courses = LookupCache('saba_course')
+
+
 def get_credentials_dict():
+    """Returns the credentials from S3, only downloading them again when
+    their ETag has changed."""
+    global cached_credentials
     key = 'hpe/{}/creds.json'.format(os.environ['STAGE'])
-    data = s3.get_object(Bucket='caveon-private', Key=key)
-    return json.loads(data['Body'].read())
+    kwargs = {'IfNoneMatch': cached_credentials[0]} if cached_credentials else {}
+    s3 = get_s3()
+    try:
+        data = s3.get_object(Bucket='caveon-private', Key=key, **kwargs)
+    except s3.exceptions.ClientError as e:
+        if cached_credentials and e.response['Error']['Code'] in ('304', 'NotModified'):
+            count_cache('credentials', True)
+            return cached_credentials[1]
+        raise
+    count_cache('credentials', False)
+    cached_credentials = (data['ETag'], json.loads(data['Body'].read()))
+    return cached_credentials[1]
 
 
 def get_delivery_json(exam_id, delivery_id, token):
     delivery_url = '{0}/api/exams/{1}/deliveries/{2}?include=exam'.format(os.environ['SEI_URL_BASE'], exam_id,
                                                                           delivery_id)
     delivery_headers = {'Authorization': 'Bearer {0}'.format(token)}
-    delivery_response = requests.get(delivery_url, headers=delivery_headers)
+    delivery_response = requests.get(delivery_url, headers=delivery_headers, timeout=REQUEST_TIMEOUT)
     return delivery_response.json()
 
 
 def get_psi_token():
-    url = '{}/token'.format(os.environ['PSI_URL_BASE'])
-    data = {
-        'grant_type': 'password',
-        'username': os.environ.get('PSI_USERNAME', 'caveon'),
-        'password': os.environ['PSI_PASSWORD']
-    }
-    response = requests.post(url=url, data=data, auth=HTTPBasicAuth(username=os.environ['PSI_CONSUMER_KEY'], password=os.environ['PSI_CONSUMER_SECRET']))
-    return response.json()['access_token']
+    global cached_psi_token
+    # batches send many deliveries at once, only one of them gets a token
+    with psi_token_lock:
+        if cached_psi_token and time.monotonic() < cached_psi_token[1]:
+            count_cache('psi_token', True)
+            return cached_psi_token[0]
+
+        count_cache('psi_token', False)
+        url = '{}/token'.format(os.environ['PSI_URL_BASE'])
+        data = {
+            'grant_type': 'password',
+            'username': os.environ.get('PSI_USERNAME', 'caveon'),
+            'password': os.environ['PSI_PASSWORD']
+        }
+        response = requests.post(url=url, data=data, auth=HTTPBasicAuth(username=os.environ['PSI_CONSUMER_KEY'], password=os.environ['PSI_CONSUMER_SECRET']),
+                                 timeout=REQUEST_TIMEOUT)
+        token_json = response.json()
+        expires_at = time.monotonic() + token_json.get('expires_in', 0) - PSI_TOKEN_MARGIN
+        cached_psi_token = (token_json['access_token'], expires_at)
+        return cached_psi_token[0]
 
 
 def send_to_psi(delivery_json):
@@ -134,60 +394,91 @@ def send_to_psi(delivery_json):
     headers = {
         'Authorization': 'Bearer {}'.format(psi_token)
     }
-    r = requests.put(url, json=payload, headers=headers)
+    r = requests.put(url, json=payload, headers=headers, timeout=REQUEST_TIMEOUT)
     return {'Status Code': r.status_code}
 
 
-def get_saba_cert():
-    url = '{}/v1/login'.format(os.environ['SABA_URL_BASE'])
-    headers = {
-        'user': os.environ['SABA_USER'],
-        'password': os.environ['SABA_PASSWORD'],
-        'site': os.environ['SABA_SITE']
-    }
-    r = requests.get(url, headers=headers)
-    return r.json()['certificate']
+def get_saba_cert(refresh=False):
+    global cached_saba_cert
+    # the person and course lookups run side by side, only one of them logs in
+    with saba_cert_lock:
+        if cached_saba_cert and not refresh:
+            count_cache('saba_cert', True)
+            return cached_saba_cert
+
+        count_cache('saba_cert', False)
+        url = '{}/v1/login'.format(os.environ['SABA_URL_BASE'])
+        headers = {
+            'user': os.environ['SABA_USER'],
+            'password': os.environ['SABA_PASSWORD'],
+            'site': os.environ['SABA_SITE']
+        }
+        r = requests.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+        cached_saba_cert = r.json()['certificate']
+        return cached_saba_cert
 
 
-def get_saba_person_id(certificate, unique_id):
+def saba_request(method, url, **kwargs):
+    """Makes a Saba request with the cached certificate, logging in again
+    when Saba no longer accepts it and the call has time left for that."""
+    if time_left() <= 0:
+        # the call was given up on, nothing more is sent for it
+        raise futures.TimeoutError('{} {} after the call timed out'.format(method, url))
+    r = requests.request(method, url, headers={'SabaCertificate': get_saba_cert()}, timeout=REQUEST_TIMEOUT, **kwargs)
+    if r.status_code == 401 and time_left() > 2 * REQUEST_TIMEOUT:
+        r = requests.request(method, url, headers={'SabaCertificate': get_saba_cert(refresh=True)},
+                             timeout=REQUEST_TIMEOUT, **kwargs)
+    return r
+
+
+def get_saba_person_id(unique_id):
     if not unique_id:
         unique_id = '994633d0271065fd25248485dd83c363'
+    return saba_people.get(unique_id, lookup_saba_person_id)
+
+
+def lookup_saba_person_id(unique_id):
     url = '{}/v1/people/username={}'.format(os.environ['SABA_URL_BASE'], unique_id)
-    headers = {
-        'SabaCertificate': certificate
-    }
-    r = requests.get(url, headers=headers)
+    r = saba_request('GET', url)
     return r.json().get('id')
 
 
-def get_saba_course_id(readable_course_id=None):
-    # TODO: get the readable_course_id from the exam title and make a request here:
-    # https://hpe-itg-api.sabacloud.com/v1/course/course_no=HPE1-H01
-    # then return the r.json()['id']
-    # hardcoded for now
-    return 'cours000000001189168'
+def get_saba_course_id(exam_name):
+    match = COURSE_NO_PATTERN.match(exam_name or '')
+    course_id = saba_courses.get(match.group(1), lookup_saba_course_id) if match else None
+    if not course_id:
+        logger.warning('no saba course for exam %r, using the default course %r', exam_name, SABA_DEFAULT_COURSE_ID)
+        return SABA_DEFAULT_COURSE_ID or None
+    return course_id
+
+
+def lookup_saba_course_id(course_no):
+    url = '{}/v1/course/course_no={}'.format(os.environ['SABA_URL_BASE'], course_no)
+    r = saba_request('GET', url)
+    if r.status_code != 200:
+        return None
+    return r.json().get('id')
 
 
 def send_to_saba(delivery_json):
     examinee_info = delivery_json['examinee']['info']
     unique_id = examinee_info.get('uniqueID')
-    cert = get_saba_cert()
-    course_id = get_saba_course_id()
-    person_id = get_saba_person_id(cert, unique_id)
-
-    if person_id:
-        url = '{}/v1/transcript'.format(os.environ['SABA_URL_BASE'])
-        headers = {
-            'SabaCertificate': cert
-        }
-        payload = build_saba_payload(course_id, person_id, delivery_json['score'])
-
-        r = requests.post(url, headers=headers, json=payload)
-        status_code = r.status_code
-    else:
-        status_code = None
-
-    return {'Status Code': status_code}
+    exam_name = delivery_json['exam']['name']
+    # the course doesn't depend on the person, look it up in the meantime
+    course_future = lookup_executor.submit(run_until, getattr(call_deadline, 'at', None), get_saba_course_id,
+                                           exam_name)
+    person_id = get_saba_person_id(unique_id)
+    course_id = course_future.result()
+
+    if not person_id:
+        return {'Status Code': None, 'Error': 'no Saba person for {0}'.format(unique_id)}
+    if not course_id:
+        return {'Status Code': None, 'Error': 'no Saba course for exam {0}'.format(exam_name)}
+
+    url = '{}/v1/transcript'.format(os.environ['SABA_URL_BASE'])
+    payload = build_saba_payload(course_id, person_id, delivery_json['score'])
+    r = saba_request('POST', url, json=payload)
+    return {'Status Code': r.status_code}
 
 
 def build_saba_payload(course_id, person_id, score):
@@ -280,7 +571,7 @@ def build_saba_payload(course_id, person_id, score):
 
 
 def check_ip():
-    r = requests.get('https://api.ipify.org?format=json')
+    r = requests.get('https://api.ipify.org?format=json', timeout=REQUEST_TIMEOUT)
     return r.json()
 
 
@@ -309,14 +600,39 @@ def send_to_slack(delivery_json, psi_response, saba_response, ip_response):
         psi_attachment = format_attachment('PSI Status', psi_response)
         saba_attachment = format_attachment('SABA Status', saba_response)
         ip_attachment = format_attachment('Connector IP', ip_response)
+        cache_attachment = format_attachment('Connector Caches', cache_stats())
+
+        slack_payload = {
+            'username': 'HPE Connector',
+            'icon_emoji': ':owl:',
+            'channel': channel,
+            'attachments': [examinee_attachment, delivery_attachment, psi_attachment, saba_attachment, ip_attachment,
+                            cache_attachment]
+        }
+        requests.post(webhook_url, json=slack_payload, timeout=REQUEST_TIMEOUT)
+
+
+def send_batch_to_slack(results, failed):
+    webhook_url = os.environ.get('SLACK_WEBHOOK_URL')
+    if webhook_url:
+        channel = os.environ.get('SLACK_CHANNEL', '#dev')
+        summary_attachment = {
+            'pretext': 'Resent {0} deliveries to PSI and SABA, {1} failed'.format(len(results), failed),
+            'title': 'Delivery Results',
+            'text': '```{0}```'.format(json.dumps(results, sort_keys=True, indent=4, separators=(',', ': '))),
+            'mrkdwn_in': [
+                'text'
+            ]
+        }
+        cache_attachment = format_attachment('Connector Caches', cache_stats())
 
         slack_payload = {
             'username': 'HPE Connector',
             'icon_emoji': ':owl:',
             'channel': channel,
-            'attachments': [examinee_attachment, delivery_attachment, psi_attachment, saba_attachment, ip_attachment]
+            'attachments': [summary_attachment, cache_attachment]
         }
-        requests.post(webhook_url, json=slack_payload)
+        requests.post(webhook_url, json=slack_payload, timeout=REQUEST_TIMEOUT)
 
 
 def format_attachment(title, data):
@@ -8,9 +8,14 @@ from flask import Flask, render_template, request, abort, jsonify, redirect, url
 from flask_wtf import FlaskForm
 from redis import StrictRedis
 from requests.auth import HTTPBasicAuth
+from rq import get_current_job
+from rq.decorators import job
+from rq_scheduler import Scheduler
 from werkzeug.contrib.fixers import ProxyFix
 from wtforms import StringField, IntegerField
 
+from caches import TTLCache, TokenCache
+
 
 # app setup
 app = Flask(__name__)
@@ -22,6 +27,7 @@ app.url_map.strict_slashes = False
 
 # some helpers
 redis_store = StrictRedis.from_url(app.config['REDIS_URL'], db=app.config['REDIS_DB'], decode_responses=True)
+rq_store = StrictRedis.from_url(app.config['REDIS_URL'], db=app.config['REDIS_DB'])
 pool = ThreadPool(4)
 
 
@@ -30,7 +36,11 @@ def make_request(request_dict):
     return response.json()
 
 
-def get_integration_info(exam_id):
+integration_info_cache = TTLCache(app.config['INTEGRATION_CACHE_SIZE'], app.config['INTEGRATION_CACHE_TTL'],
+                                  name='integration_info')
+
+
+def load_integration_info(exam_id):
     data = redis_store.get(exam_id)
     if data:
         return loads(data)
@@ -43,6 +53,24 @@ def get_integration_info(exam_id):
     return data
 
 
+def get_integration_info(exam_id, fresh=False):
+    # fresh=True skips the cached copy, for callers that change and save it
+    if fresh:
+        data = load_integration_info(exam_id)
+        integration_info_cache.set(exam_id, data)
+    else:
+        data = integration_info_cache.get(exam_id, load_integration_info)
+    return dict(data)
+
+
+def save_integration_info(exam_id, data):
+    redis_store.set(exam_id, dumps(data))
+    integration_info_cache.set(exam_id, dict(data))
+
+
+token_cache = TokenCache(app.config['JWT_CACHE_SIZE'])
+
+
 def build_template_data(delivery, to_dict):
     try:
         score_percent = delivery['points_earned'] / delivery['points_available']
@@ -82,6 +110,73 @@ def build_to(name_map, email_map, examinee_info):
     return {'name': name, 'email': email}
 
 
+def should_retry(error, attempt):
+    """Whether a failed job is worth trying again: only connection problems
+    and 5xx or 429 answers, and only JOB_RETRIES times."""
+    if attempt >= app.config['JOB_RETRIES']:
+        return False
+    if isinstance(error, requests.HTTPError):
+        status_code = error.response.status_code if error.response is not None else 0
+        return status_code >= 500 or status_code == 429
+    return isinstance(error, requests.RequestException)
+
+
+def retry_later(attempt, func, *args, **kwargs):
+    """Schedules the job again on the queue it came from, after
+    JOB_RETRY_BACKOFF seconds and twice as long each attempt after. The
+    scheduler (python scheduler.py) moves it onto the queue when it's due."""
+    current_job = get_current_job()
+    queue_name = current_job.origin if current_job else app.config['QUEUES'][0]
+    scheduler = Scheduler(queue_name=queue_name, connection=rq_store)
+    delay = timedelta(seconds=app.config['JOB_RETRY_BACKOFF'] * 2 ** attempt)
+    scheduler.enqueue_in(delay, func, *args, attempt=attempt + 1, **kwargs)
+
+
+def send_event(exam_id, delivery_id, event, sent):
+    integration_info = get_integration_info(exam_id)
+
+    # get full delivery object from SEI
+    # TODO: only do this for delivery type events
+    delivery_url = '{0}/api/exams/{1}/deliveries/{2}?include=exam,breakdown_objects,score_token'.format(app.config['SEI_URL_BASE'], exam_id, delivery_id)
+    delivery_headers = {'Authorization': 'Bearer {0}'.format(integration_info['token'])}
+    delivery_response = requests.get(delivery_url, headers=delivery_headers)
+    delivery_response.raise_for_status()
+    delivery_json = delivery_response.json()
+    examinee_info = delivery_json['examinee']['info']
+    api_key = integration_info.get('api_key')
+    if api_key:
+        configs = integration_info.get('configs', [])
+        sg_url = 'https://api.sendgrid.com/v3/mail/send'
+        sg_headers = {'Authorization': 'Bearer {0}'.format(api_key)}
+        for i, config in enumerate(configs):
+            if config['event'] == event and i not in sent:
+                to_dict = build_to(config['name'], config['email'], examinee_info)
+                from_dict = {'name': config.get('sender_name'), 'email': config.get('sender_email')}
+                sg_payload = {
+                    'from': from_dict,
+                    'template_id': config['template_id'],
+                    'personalizations': [{
+                        'to': [to_dict],
+                        'dynamic_template_data': build_template_data(delivery_json, to_dict)
+                    }]
+                }
+                sg_response = requests.post(sg_url, json=sg_payload, headers=sg_headers)
+                sg_response.raise_for_status()
+                sent.add(i)
+
+
+@job('default', connection=rq_store)
+def post_event(exam_id, delivery_id, event, sent=(), attempt=0):
+    # emails that went out are left out when trying again
+    sent = set(sent)
+    try:
+        send_event(exam_id, delivery_id, event, sent)
+    except Exception as e:
+        if not should_retry(e, attempt):
+            raise
+        retry_later(attempt, post_event, exam_id, delivery_id, event, sent=sorted(sent))
+
+
 class ApiKeyForm(FlaskForm):
     # TODO: build api key validator
     api_key = StringField('API Key')
@@ -110,7 +205,7 @@ def sei_redirect():
         existing_data = loads(existing_data)
         existing_data.update(data)
         data = existing_data
-    redis_store.set(exam_id, dumps(data))
+    save_integration_info(exam_id, data)
     now = datetime.utcnow()
     exp_seconds = 3600
     exp_time = (now + timedelta(seconds=exp_seconds))
@@ -128,37 +223,12 @@ def events():
     auth_header = request.headers.get('Authorization')
     token = auth_header.split()[1]
     try:
-        decoded = jwt.decode(token, integration_info['secret'], algorithms=['HS256'])
+        decoded = token_cache.decode(token, integration_info['secret'])
     except jwt.exceptions.InvalidTokenError:
         return jsonify(), 403
 
-    # get full delivery object from SEI
-    # TODO: only do this for delivery type events
-    delivery_id = body['delivery_id']
-    delivery_url = '{0}/api/exams/{1}/deliveries/{2}?include=exam,breakdown_objects,score_token'.format(app.config['SEI_URL_BASE'], exam_id, delivery_id)
-    delivery_headers = {'Authorization': 'Bearer {0}'.format(integration_info['token'])}
-    delivery_response = requests.get(delivery_url, headers=delivery_headers)
-    delivery_json = delivery_response.json()
-    examinee_info = delivery_json['examinee']['info']
-    api_key = integration_info.get('api_key')
-    if api_key:
-        event = body['event']
-        configs = integration_info.get('configs', [])
-        sg_url = 'https://api.sendgrid.com/v3/mail/send'
-        sg_headers = {'Authorization': 'Bearer {0}'.format(api_key)}
-        for config in configs:
-            if config['event'] == event:
-                to_dict = build_to(config['name'], config['email'], examinee_info)
-                from_dict = {'name': config.get('sender_name'), 'email': config.get('sender_email')}
-                sg_payload = {
-                    'from': from_dict,
-                    'template_id': config['template_id'],
-                    'personalizations': [{
-                        'to': [to_dict],
-                        'dynamic_template_data': build_template_data(delivery_json, to_dict)
-                    }]
-                }
-                requests.post(sg_url, json=sg_payload, headers=sg_headers)
+    # the emails are sent by a worker, so SEI isn't kept waiting
+    post_event.delay(exam_id, body['delivery_id'], body['event'])
     return jsonify()
 
 
@@ -169,7 +239,7 @@ def delivery_widget():
     token = request.args.get('jwt')
     integration_info = get_integration_info(exam_id)
     try:
-        decoded = jwt.decode(token, integration_info['secret'], algorithms=['HS256'])
+        decoded = token_cache.decode(token, integration_info['secret'])
     except jwt.exceptions.InvalidTokenError:
         abort(403)
     configs = integration_info.get('configs', [])
@@ -188,7 +258,7 @@ def switch():
     token = request.args.get('jwt')
     integration_info = get_integration_info(exam_id)
     try:
-        decoded = jwt.decode(token, integration_info['secret'], algorithms=['HS256'])
+        decoded = token_cache.decode(token, integration_info['secret'])
     except jwt.exceptions.InvalidTokenError:
         abort(403)
 
@@ -201,15 +271,15 @@ def switch():
 def api_key():
     exam_id = request.args.get('exam_id')
     token = request.args.get('jwt')
-    integration_info = get_integration_info(exam_id)
+    integration_info = get_integration_info(exam_id, fresh=True)
     try:
-        decoded = jwt.decode(token, integration_info['secret'], algorithms=['HS256'])
+        decoded = token_cache.decode(token, integration_info['secret'])
     except jwt.exceptions.InvalidTokenError:
         abort(403)
     form = ApiKeyForm(api_key=integration_info.get('api_key'))
     if form.validate_on_submit():
         integration_info['api_key'] = form.api_key.data
-        redis_store.set(exam_id, dumps(integration_info))
+        save_integration_info(exam_id, integration_info)
         return redirect(url_for('configure', exam_id=exam_id, jwt=token))
     bad_key = request.args.get('bad_key') == 'true'
     return render_template('api_key.html', form=form, bad_key=bad_key)
@@ -221,7 +291,7 @@ def configure():
     token = request.args.get('jwt')
     integration_info = get_integration_info(exam_id)
     try:
-        decoded = jwt.decode(token, integration_info['secret'], algorithms=['HS256'])
+        decoded = token_cache.decode(token, integration_info['secret'])
     except jwt.exceptions.InvalidTokenError:
         abort(403)
 
@@ -255,13 +325,13 @@ def post_configuration():
     data = request.get_json()
     exam_id = request.args.get('exam_id')
     token = request.args.get('jwt')
-    integration_info = get_integration_info(exam_id)
+    integration_info = get_integration_info(exam_id, fresh=True)
     try:
-        decoded = jwt.decode(token, integration_info['secret'], algorithms=['HS256'])
+        decoded = token_cache.decode(token, integration_info['secret'])
     except jwt.exceptions.InvalidTokenError:
         return jsonify(), 403
     integration_info['configs'] = data['configs']
-    redis_store.set(exam_id, dumps(integration_info))
+    save_integration_info(exam_id, integration_info)
     return jsonify()
 
 
@@ -8,10 +8,15 @@ from flask_wtf import FlaskForm
 from flask_wtf.csrf import CSRFProtect
 from redis import StrictRedis
 from requests.auth import HTTPBasicAuth
+from rq import get_current_job
+from rq.decorators import job
+from rq_scheduler import Scheduler
 from werkzeug.contrib.fixers import ProxyFix
 from wtforms import StringField
 from wtforms.validators import URL, ValidationError
 
+from caches import TTLCache, TokenCache
+
 
 # app setup
 app = Flask(__name__)
@@ -26,9 +31,14 @@ csrf = CSRFProtect(app)
 
 # some helpers
 redis_store = StrictRedis.from_url(app.config['REDIS_URL'], db=app.config['REDIS_DB'], decode_responses=True)
+rq_store = StrictRedis.from_url(app.config['REDIS_URL'], db=app.config['REDIS_DB'])
+
 
+integration_info_cache = TTLCache(app.config['INTEGRATION_CACHE_SIZE'], app.config['INTEGRATION_CACHE_TTL'],
+                                  name='integration_info')
 
-def get_integration_info(exam_id):
+
+def load_integration_info(exam_id):
     data = redis_store.get(exam_id)
     if data:
         return loads(data)
@@ -41,6 +51,101 @@ def get_integration_info(exam_id):
     return data
 
 
+def get_integration_info(exam_id, fresh=False):
+    # fresh=True skips the cached copy, for callers that change and save it
+    if fresh:
+        data = load_integration_info(exam_id)
+        integration_info_cache.set(exam_id, data)
+    else:
+        data = integration_info_cache.get(exam_id, load_integration_info)
+    return dict(data)
+
+
+def save_integration_info(exam_id, data):
+    redis_store.set(exam_id, dumps(data))
+    integration_info_cache.set(exam_id, dict(data))
+
+
+token_cache = TokenCache(app.config['JWT_CACHE_SIZE'])
+
+
+def should_retry(error, attempt):
+    """Whether a failed job is worth trying again: only connection problems
+    and 5xx or 429 answers, and only JOB_RETRIES times."""
+    if attempt >= app.config['JOB_RETRIES']:
+        return False
+    if isinstance(error, requests.HTTPError):
+        status_code = error.response.status_code if error.response is not None else 0
+        return status_code >= 500 or status_code == 429
+    return isinstance(error, requests.RequestException)
+
+
+def retry_later(attempt, func, *args, **kwargs):
+    """Schedules the job again on the queue it came from, after
+    JOB_RETRY_BACKOFF seconds and twice as long each attempt after. The
+    scheduler (python scheduler.py) moves it onto the queue when it's due."""
+    current_job = get_current_job()
+    queue_name = current_job.origin if current_job else app.config['QUEUES'][0]
+    scheduler = Scheduler(queue_name=queue_name, connection=rq_store)
+    delay = timedelta(seconds=app.config['JOB_RETRY_BACKOFF'] * 2 ** attempt)
+    scheduler.enqueue_in(delay, func, *args, attempt=attempt + 1, **kwargs)
+
+
+def send_delivery(exam_id, delivery_id):
+    integration_info = get_integration_info(exam_id)
+
+    # get full delivery object from SEI
+    delivery_url = '{0}/api/exams/{1}/deliveries/{2}?include=exam'.format(app.config['SEI_URL_BASE'], exam_id, delivery_id)
+    delivery_headers = {'Authorization': 'Bearer {0}'.format(integration_info['token'])}
+    delivery_response = requests.get(delivery_url, headers=delivery_headers)
+    delivery_response.raise_for_status()
+    delivery_json = delivery_response.json()
+
+    slack_webhook_url = integration_info.get('slack_webhook_url')
+    if slack_webhook_url:
+        channel = integration_info.get('slack_channel') or '#general'
+        examinee_attachment = {
+            'pretext': 'Someone has completed a delivery in the {0} exam'.format(delivery_json['exam']['name']),
+            'title': 'Examinee Info',
+            'text': '```{0}```'.format(dumps(delivery_json['examinee']['info'], sort_keys=True, indent=4, separators=(',', ': '))),
+            'mrkdwn_in': [
+                'text'
+            ]
+        }
+        delivery_info = {
+            'score': delivery_json['score'],
+            'score_scale': delivery_json['score_scale'],
+            'passed': delivery_json['passed'],
+            'points_earned': delivery_json['points_earned'],
+            'points_available': delivery_json['points_available']
+        }
+        delivery_attachment = {
+            'title': 'Delivery Info',
+            'text': '```{0}```'.format(dumps(delivery_info, sort_keys=True, indent=4, separators=(',', ': '))),
+            'mrkdwn_in': [
+                'text'
+            ]
+        }
+        slack_payload = {
+            'username': 'SEI Slack Connector',
+            'icon_emoji': ':owl:',
+            'channel': channel,
+            'attachments': [examinee_attachment, delivery_attachment]
+        }
+        slack_response = requests.post(slack_webhook_url, json=slack_payload)
+        slack_response.raise_for_status()
+
+
+@job('default', connection=rq_store)
+def post_delivery(exam_id, delivery_id, attempt=0):
+    try:
+        send_delivery(exam_id, delivery_id)
+    except Exception as e:
+        if not should_retry(e, attempt):
+            raise
+        retry_later(attempt, post_delivery, exam_id, delivery_id)
+
+
 class ConfigureForm(FlaskForm):
     slack_webhook_url = StringField('Webhook URL')
     slack_channel = StringField('Channel (default: #general)')
@@ -78,7 +183,7 @@ def sei_redirect():
         existing_data = loads(existing_data)
         existing_data.update(data)
         data = existing_data
-    redis_store.set(exam_id, dumps(data))
+    save_integration_info(exam_id, data)
     now = datetime.utcnow()
     exp_seconds = 3600
     exp_time = (now + timedelta(seconds=exp_seconds))
@@ -97,49 +202,12 @@ def delivery_completed():
     auth_header = request.headers.get('Authorization')
     token = auth_header.split()[1]
     try:
-        decoded = jwt.decode(token, integration_info['secret'], algorithms=['HS256'])
+        decoded = token_cache.decode(token, integration_info['secret'])
     except jwt.exceptions.InvalidTokenError:
         return jsonify(), 403
 
-    # get full delivery object from SEI
-    delivery_id = body['delivery_id']
-    delivery_url = '{0}/api/exams/{1}/deliveries/{2}?include=exam'.format(app.config['SEI_URL_BASE'], exam_id, delivery_id)
-    delivery_headers = {'Authorization': 'Bearer {0}'.format(integration_info['token'])}
-    delivery_response = requests.get(delivery_url, headers=delivery_headers)
-    delivery_json = delivery_response.json()
-
-    slack_webhook_url = integration_info.get('slack_webhook_url')
-    if slack_webhook_url:
-        channel = integration_info.get('slack_channel') or '#general'
-        examinee_attachment = {
-            'pretext': 'Someone has completed a delivery in the {0} exam'.format(delivery_json['exam']['name']),
-            'title': 'Examinee Info',
-            'text': '```{0}```'.format(dumps(delivery_json['examinee']['info'], sort_keys=True, indent=4, separators=(',', ': '))),
-            'mrkdwn_in': [
-                'text'
-            ]
-        }
-        delivery_info = {
-            'score': delivery_json['score'],
-            'score_scale': delivery_json['score_scale'],
-            'passed': delivery_json['passed'],
-            'points_earned': delivery_json['points_earned'],
-            'points_available': delivery_json['points_available']
-        }
-        delivery_attachment = {
-            'title': 'Delivery Info',
-            'text': '```{0}```'.format(dumps(delivery_info, sort_keys=True, indent=4, separators=(',', ': '))),
-            'mrkdwn_in': [
-                'text'
-            ]
-        }
-        slack_payload = {
-            'username': 'SEI Slack Connector',
-            'icon_emoji': ':owl:',
-            'channel': channel,
-            'attachments': [examinee_attachment, delivery_attachment]
-        }
-        requests.post(slack_webhook_url, json=slack_payload)
+    # the slack message is sent by a worker, so SEI isn't kept waiting
+    post_delivery.delay(exam_id, body['delivery_id'])
     return jsonify()
 
 
@@ -150,7 +218,7 @@ def delivery_widget():
     token = request.args.get('jwt')
     integration_info = get_integration_info(exam_id)
     try:
-        decoded = jwt.decode(token, integration_info['secret'], algorithms=['HS256'])
+        decoded = token_cache.decode(token, integration_info['secret'])
     except jwt.exceptions.InvalidTokenError:
         abort(403)
     return render_template('delivery_widget.html', exam_id=exam_id, delivery_id=delivery_id, token=token)
@@ -160,16 +228,16 @@ def delivery_widget():
 def configure():
     exam_id = request.args.get('exam_id')
     token = request.args.get('jwt')
-    integration_info = get_integration_info(exam_id)
+    integration_info = get_integration_info(exam_id, fresh=True)
     try:
-        decoded = jwt.decode(token, integration_info['secret'], algorithms=['HS256'])
+        decoded = token_cache.decode(token, integration_info['secret'])
     except jwt.exceptions.InvalidTokenError:
         abort(403)
     form = ConfigureForm(**integration_info)
     if form.validate_on_submit():
         integration_info['slack_webhook_url'] = form.slack_webhook_url.data
         integration_info['slack_channel'] = form.slack_channel.data
-        redis_store.set(exam_id, dumps(integration_info))
+        save_integration_info(exam_id, integration_info)
         return redirect(url_for('complete'))
     return render_template('configure.html', exam_id=exam_id, token=token, form=form)
 